@@ -1,13 +1,13 @@
-import astropy.units as u
-import inspect
+"""
+Build the unit vocabulary used to autocomplete units (see `unit_vocabulary`)
+and save it to ``UNIT_VOCABULARY_FILE``.  The server also builds it on first
+use if the file is missing or out of date.
+"""
+from unit_vocabulary import (build_vocabulary, save_vocabulary,
+                             UNIT_VOCABULARY_FILE)
 
-allunits = set()
-for unitname,unit in inspect.getmembers(u):
-    if isinstance(unit, u.UnitBase):
-        try:
-            for name in unit.names:
-                allunits.add(name)
-        except AttributeError:
-            continue
+vocabulary = build_vocabulary()
+save_vocabulary(vocabulary)
 
-print(allunits)
+print("Saved {0} unit names to {1}".format(len(vocabulary['units']),
+                                           UNIT_VOCABULARY_FILE))
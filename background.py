@@ -0,0 +1,48 @@
+"""
+Helpers shared by the background services of the server.
+
+The submission queue (`submission_queue`) and the artifact janitor
+(`janitor`) both keep their state in a SQLite file that all the server
+processes share, and both do their work in a daemon thread that is started
+once per process.
+"""
+
+import os
+import sqlite3
+import threading
+
+_threads = {}
+_threads_lock = threading.Lock()
+
+
+def connect_database(database, schema=(), row_factory=None):
+    """
+    Open a SQLite database in autocommit mode, creating its folder and
+    running the ``schema`` statements (``CREATE ... IF NOT EXISTS``) first
+    """
+    dirname = os.path.dirname(database)
+    if dirname and not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    connection = sqlite3.connect(database, timeout=30,
+                                 isolation_level=None)
+    if row_factory is not None:
+        connection.row_factory = row_factory
+    for statement in schema:
+        connection.execute(statement)
+    return connection
+
+
+def start_daemon(name, target, **kwargs):
+    """
+    Run ``target(**kwargs)`` in a daemon thread called ``name``, unless this
+    process already has a live thread of that name started here
+    """
+    with _threads_lock:
+        thread = _threads.get(name)
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=target, kwargs=kwargs,
+                                      name=name)
+            thread.daemon = True
+            thread.start()
+            _threads[name] = thread
+    return thread
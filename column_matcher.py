@@ -0,0 +1,234 @@
+"""
+Matching of the column names of an upload to the columns of the database.
+
+The column form suggests a database column for each column of an uploaded
+table.  `ColumnMatcher` makes these suggestions from two sources:
+
+* a dictionary of synonyms: column names that are known to stand for a
+  database column, e.g. ``NH2`` for SurfaceDensity or ``DeltaV`` for
+  VelocityDispersion.  Besides the built-in ``column_synonyms``, the
+  mappings chosen by the submitters are counted, those of earlier uploads
+  from their ``*_formdata.json`` files (`stored_forms`) and new ones as they
+  are submitted (`ColumnMatcher.add_form`): a column name stands for the
+  target it was mapped to most often.
+* fuzzy matching, with the same similarity ratio as `difflib`, of the column
+  name against those database columns that share at least one character
+  n-gram with it (found through an n-gram index of the database columns).
+  Names shorter than ``FUZZY_MIN_LENGTH`` are not matched this way, and
+  neither are the bookkeeping columns (``exact_targets``), which short
+  column names like ``Flag`` or ``GLAT`` resemble by chance.
+
+Names are compared in lowercase and without punctuation.  The candidates of
+each column name are computed once and memoized, and so are the mappings of
+whole lists of column names, which never change for the query form.
+"""
+
+import os
+import re
+import glob
+import json
+import difflib
+from collections import Counter, defaultdict
+from astropy import log
+
+NGRAM_LENGTH = 2
+MATCH_CUTOFF = 0.7
+# Shortest (normalized) column name that is matched fuzzily
+FUZZY_MIN_LENGTH = 4
+# Score of a synonym: below that of the exact name of a target only
+SYNONYM_SCORE = 0.99
+# Number of column names and of lists of column names to memoize
+MEMO_SIZE = 10000
+
+# Column names that stand for a database column, normalized (see
+# `normalize_colname`)
+column_synonyms = {'id': 'IDs', 'ids': 'IDs', 'source': 'IDs',
+                   'surfdens': 'SurfaceDensity', 'nh2': 'SurfaceDensity',
+                   'sigma': 'SurfaceDensity', 'sigmagas': 'SurfaceDensity',
+                   'columndensity': 'SurfaceDensity',
+                   'vdisp': 'VelocityDispersion',
+                   'deltav': 'VelocityDispersion',
+                   'dv': 'VelocityDispersion',
+                   'sigmav': 'VelocityDispersion',
+                   'veldisp': 'VelocityDispersion',
+                   'radius': 'Radius', 'radius20': 'Radius', 'r': 'Radius',
+                   'reff': 'Radius', 'rad': 'Radius',
+                   'issim': 'IsSimulated', 'issimulated': 'IsSimulated',
+                   'isgal': 'IsGalactic', 'isgalactic': 'IsGalactic'}
+
+# Database columns that are only matched by their exact name or a synonym
+exact_targets = ('Filename', 'DataURL', 'synthimURL', 'Username',
+                 'IsSimulated', 'IsGalactic')
+
+_punctuation = re.compile("[^a-z0-9]")
+
+
+def normalize_colname(name):
+    """
+    Lowercase a column name and remove everything but letters and digits
+    """
+    return _punctuation.sub("", name.lower())
+
+
+def ngrams(name, n=NGRAM_LENGTH):
+    """
+    The character n-grams of a normalized name, padded so that short names
+    have n-grams too
+    """
+    padded = '^' + name + '$'
+    return set(padded[i:i + n] for i in range(len(padded) - n + 1))
+
+
+def stored_forms(upload_folder):
+    """
+    Iterate over the stored forms of earlier uploads
+    (``<upload_folder>/*_formdata.json``), skipping unreadable ones
+    """
+    for filename in glob.glob(os.path.join(upload_folder,
+                                           '*_formdata.json')):
+        try:
+            with open(filename) as f:
+                yield json.load(f)
+        except (IOError, ValueError) as ex:
+            log.debug("Could not read {0}: {1}".format(filename, ex))
+
+
+class ColumnMatcher(object):
+    """
+    Match column names to a list of target (database) column names.
+
+    Parameters
+    ----------
+    targets : list
+        The names to match to
+    synonyms : dict
+        ``{column name: target}`` of names known to stand for a target;
+        synonyms of names that are not targets are ignored
+    forms : iterable
+        Column forms of earlier uploads to count (see `add_form`)
+    ignore_fields : list
+        The fields of the forms that are not column names
+    exact_targets : list
+        The targets that are not matched fuzzily
+    cutoff : float
+        The lowest similarity ratio of a fuzzy match
+    """
+    def __init__(self, targets, synonyms=None, forms=(), ignore_fields=(),
+                 exact_targets=exact_targets, cutoff=MATCH_CUTOFF):
+        self.targets = list(targets)
+        self.ignore_fields = ignore_fields
+        self.cutoff = cutoff
+        self.normalized = [normalize_colname(target)
+                           for target in self.targets]
+        self.exact = dict(zip(self.normalized, self.targets))
+        self.index = defaultdict(set)
+        for position, name in enumerate(self.normalized):
+            if self.targets[position] in exact_targets:
+                continue
+            for ngram in ngrams(name):
+                self.index[ngram].add(position)
+        self.synonyms = {}
+        # number of times each column name was mapped to each target
+        self.counts = defaultdict(Counter)
+        self.add_synonyms(synonyms or {})
+        for form_data in forms:
+            self.add_form(form_data)
+
+    def add_synonyms(self, synonyms):
+        """
+        Add ``{column name: target}`` synonyms, forgetting the matches made
+        so far
+        """
+        self.synonyms.update((normalize_colname(name), target)
+                             for name, target in synonyms.items()
+                             if target in self.targets)
+        self._candidates = {}
+        self._matches = {}
+
+    def add_form(self, form_data):
+        """
+        Count the ``{column name: target}`` mappings of a submitted column
+        form.  Each column name becomes a synonym of the target it was mapped
+        to most often, over all the forms counted so far.
+        """
+        names = set()
+        for field, value in form_data.items():
+            if isinstance(value, list):
+                # forms stored from a MultiDict hold lists of values
+                value = value[0] if value else None
+            name = normalize_colname(field)
+            if (name and value in self.targets and
+                    field not in self.targets and
+                    field not in self.ignore_fields):
+                self.counts[name][value] += 1
+                names.add(name)
+        if names:
+            self.add_synonyms({name: self.counts[name].most_common(1)[0][0]
+                               for name in names})
+
+    def candidates(self, colname):
+        """
+        The targets that ``colname`` could stand for, as a list of
+        ``(score, target)`` with a score of at least ``cutoff``, best first.
+        An exact match scores 1 and a synonym ``SYNONYM_SCORE``; names
+        shorter than ``FUZZY_MIN_LENGTH`` have no other candidates.
+        """
+        if colname in self._candidates:
+            return self._candidates[colname]
+        if len(self._candidates) >= MEMO_SIZE:
+            self._candidates = {}
+
+        name = normalize_colname(colname)
+        scores = {}
+        if name in self.synonyms:
+            scores[self.synonyms[name]] = SYNONYM_SCORE
+        if name in self.exact:
+            scores[self.exact[name]] = 1.
+        positions = set()
+        if len(name) >= FUZZY_MIN_LENGTH:
+            for ngram in ngrams(name):
+                positions.update(self.index.get(ngram, ()))
+        matcher = difflib.SequenceMatcher(b=name)
+        for position in positions:
+            target = self.targets[position]
+            matcher.set_seq1(self.normalized[position])
+            score = matcher.ratio()
+            if score >= self.cutoff and score > scores.get(target, 0):
+                scores[target] = score
+
+        result = sorted(((score, target) for target, score in scores.items()),
+                        key=lambda pair: (-pair[0],
+                                          self.targets.index(pair[1])))
+        self._candidates[colname] = result
+        return result
+
+    def match(self, colnames):
+        """
+        Map column names to targets, ``{column name: target}``.  Every target
+        goes to at most one column, the best scoring one, and columns with
+        no good enough match are left out.
+        """
+        colnames = tuple(colnames)
+        if colnames in self._matches:
+            return self._matches[colnames]
+        if len(self._matches) >= MEMO_SIZE:
+            self._matches = {}
+
+        pairs = sorted(((score, order, colname, target)
+                        for order, colname in enumerate(colnames)
+                        for score, target in self.candidates(colname)),
+                       key=lambda pair: (-pair[0], pair[1]))
+        mapping = {}
+        for score, order, colname, target in pairs:
+            if colname not in mapping and target not in mapping.values():
+                mapping[colname] = target
+
+        self._matches[colnames] = mapping
+        return mapping
+
+    def best_column_names(self, colnames, default='Ignore'):
+        """
+        The target matched to each of ``colnames``, or ``default``
+        """
+        mapping = self.match(colnames)
+        return [mapping.get(colname, default) for colname in colnames]
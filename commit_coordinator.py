@@ -0,0 +1,74 @@
+"""
+Serialize the git operations of submissions.
+
+Every submission branches off ``origin/master`` of the ``database`` and
+``uploads`` submodules, commits and pushes.  Doing that in the shared
+checkouts lets two server processes trample on each other's working tree, so
+instead each batch of submissions:
+
+* holds an inter-process lock (``flock`` on a file in ``LOCK_FOLDER``) per
+  submodule for the whole branch / commit / push sequence, and
+* works in a temporary ``git worktree`` of the submodule, so the shared
+  checkouts served by the web pages are never switched to another branch.
+"""
+
+import os
+import fcntl
+import shutil
+import tempfile
+import subprocess
+from contextlib import contextmanager
+from astropy import log
+
+LOCK_FOLDER = 'jobs/locks/'
+
+
+@contextmanager
+def submodule_lock(name, lock_dir=LOCK_FOLDER):
+    """
+    Hold an exclusive lock on the named submodule, blocking until it is
+    available.  The lock is shared between all processes on this machine.
+    """
+    if not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir)
+    with open(os.path.join(lock_dir, name + '.lock'), 'w') as lockfile:
+        log.debug("Waiting for the {0} lock".format(name))
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+
+@contextmanager
+def temporary_worktree(workingdir, remote='origin', branch='master'):
+    """
+    Check out an up-to-date ``remote/branch`` of the repository in
+    ``workingdir`` into a temporary worktree, and remove it afterwards.
+    Yields the path of the worktree.
+    """
+    fetch_result = subprocess.call(['git', 'fetch', remote], cwd=workingdir)
+    if fetch_result != 0:
+        raise Exception("Fetching {remote} in {workingdir} failed"
+                        .format(remote=remote, workingdir=workingdir))
+
+    tmpdir = tempfile.mkdtemp(prefix='camelot_worktree_')
+    path = os.path.join(tmpdir,
+                        os.path.basename(os.path.normpath(workingdir)))
+    add_result = \
+        subprocess.call(['git', 'worktree', 'add', '--detach', path,
+                         '{remote}/{branch}'.format(remote=remote,
+                                                    branch=branch)],
+                        cwd=workingdir)
+    if add_result != 0:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise Exception("Creating a worktree of {workingdir} failed"
+                        .format(workingdir=workingdir))
+
+    try:
+        yield path
+    finally:
+        subprocess.call(['git', 'worktree', 'remove', '--force', path],
+                        cwd=workingdir)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        subprocess.call(['git', 'worktree', 'prune'], cwd=workingdir)
@@ -77,14 +77,14 @@ rename_columns(benoitcommercon)
 set_units(benoitcommercon)
 add_name_column(benoitcommercon, 'BenoitCommercon')
 benoitcommercon = reorder_columns(benoitcommercon, tbl.colnames)
-append_table(tbl, benoitcommercon)
+tbl = append_table(tbl, benoitcommercon)
 
 carabattersby = fix_logical(ascii.read('carabattersby.csv'))
 rename_columns(carabattersby)
 set_units(carabattersby)
 add_name_column(carabattersby, 'CaraBattersby')
 carabattersby = reorder_columns(carabattersby, tbl.colnames)
-append_table(tbl, carabattersby)
+tbl = append_table(tbl, carabattersby)
 
 adamginsburg = fix_logical(ascii.read('adamginsburg_bgps.csv'))
 rename_columns(adamginsburg, mapping={'name':'IDs',
@@ -97,7 +97,7 @@ set_units(adamginsburg, units={'SurfaceDensity':u.M_sun/u.pc**2,
 add_name_column(adamginsburg, 'AdamGinsburg')
 adamginsburg.add_column(table.Column(data=[False]*len(adamginsburg), name='IsSimulated'))
 adamginsburg = reorder_columns(adamginsburg, tbl.colnames)
-append_table(tbl, adamginsburg)
+tbl = append_table(tbl, adamginsburg)
 
 tbl.write("merged_table.ipac", format='ascii.ipac')
 
@@ -1,29 +1,129 @@
 import numpy as np
 from astropy import table
-from astropy.table import Table,Column
+from astropy.table import Table
 from astropy import units as u
 from astropy import log
 import re
 import string
+from unit_registry import parse_unit, conversion_factor
 
 unit_mapping = {'SurfaceDensity': u.M_sun / u.pc ** 2,
                 'VelocityDispersion': u.km / u.s,
                 'Radius': u.pc}
 
 
+# Number of values of a column looked at to infer its type
+TYPE_SAMPLE_ROWS = 1000
+
+_int_pattern = re.compile(r'[+-]?\d+$')
+_float_pattern = re.compile(r'[+-]?(\d+\.?\d*|\.\d+)([eE][+-]?\d+)?$|'
+                            r'[+-]?(nan|inf|infinity)$', re.IGNORECASE)
+
+# dtype of each inferred type, and the value given to masked entries before
+# converting strings to it
+column_types = {'float': ('float', 'nan'),
+                'int': ('int64', '0'),
+                'bool': ('bool', 'False')}
+
+# Type to try when a column does not convert to its inferred type, because a
+# value that the sample missed does not fit it
+fallback_types = {'int': 'float'}
+
+
+def infer_column_type(column, sample_rows=TYPE_SAMPLE_ROWS):
+    """
+    Classify a column as 'float', 'int', 'bool' or 'str'.  Strings are
+    classified from up to ``sample_rows`` of their (unmasked) values, spread
+    over the column: 'True' and 'False' are booleans.
+    """
+    kind = column.dtype.kind
+    if kind == 'f':
+        return 'float'
+    if kind in 'iu':
+        return 'int'
+    if kind == 'b':
+        return 'bool'
+    if kind not in 'SU':
+        return 'str'
+
+    if isinstance(column, table.MaskedColumn):
+        values = column.compressed()
+    else:
+        values = np.asarray(column)
+    if len(values) == 0:
+        return 'str'
+    step = max(1, len(values) // sample_rows)
+    sample = np.char.strip(_as_str(values[::step][:sample_rows]))
+    if np.all((sample == 'True') | (sample == 'False')):
+        return 'bool'
+    if all(_int_pattern.match(value) for value in sample):
+        return 'int'
+    if all(_float_pattern.match(value) for value in sample):
+        return 'float'
+    return 'str'
+
+
+def convert_column(column, coltype):
+    """
+    Convert a column of strings to ``coltype`` (see `infer_column_type`),
+    keeping its name, unit, description and mask.  Raises `ValueError` if a
+    value does not fit the type.
+    """
+    dtype, fill_value = column_types[coltype]
+    if isinstance(column, table.MaskedColumn):
+        mask = np.ma.getmaskarray(column)
+        values = column.filled(fill_value)
+    else:
+        mask = None
+        values = column
+    values = np.char.strip(_as_str(values))
+    if coltype == 'bool':
+        if not np.isin(values, ['True', 'False']).all():
+            raise ValueError("Not all the values are 'True' or 'False'")
+        data = values == 'True'
+    else:
+        data = values.astype(dtype)
+    kwargs = {} if mask is None else {'mask': mask}
+    return column.__class__(data=data, name=column.name, unit=column.unit,
+                            description=column.description,
+                            meta=column.meta, **kwargs)
+
+
+def _convert_columns(tbl, coltypes):
+    """
+    Convert in place the string columns of ``tbl`` whose inferred type is one
+    of ``coltypes``
+    """
+    for colname in tbl.colnames:
+        column = tbl[colname]
+        if column.dtype.kind not in 'SU':
+            continue
+        coltype = infer_column_type(column)
+        if coltype not in coltypes:
+            continue
+        newcol = None
+        while newcol is None and coltype is not None:
+            try:
+                newcol = convert_column(column, coltype)
+            except (ValueError, OverflowError) as ex:
+                # the sample did not show a value that does not fit the type
+                log.warning("Column {0} looked like {1} but is not: {2}"
+                            .format(colname, coltype, ex))
+                coltype = fallback_types.get(coltype)
+        if newcol is None:
+            continue
+        tbl.replace_column(colname, newcol)
+        log.debug("Converted column {0} from {1} to {2}"
+                  .format(colname, column.dtype, newcol.dtype))
+    return tbl
+
+
 def fix_logical(t):
     """
-    Convert a boolean column from string to boolean
+    Convert boolean columns from string ('True' / 'False') to boolean, in
+    place
     """
-    newcols = []
-    for col in list(t.columns.values()):
-        if col.dtype.str.endswith('S5') or col.dtype.str.endswith('S4'):
-            falses = col == 'False'
-            trues = col == 'True'
-            if np.all(falses | trues):
-                col = t.ColumnClass(trues, name=col.name)
-        newcols.append(col)
-    return Table(newcols)
+    return _convert_columns(t, ('bool',))
 
 
 def reorder_columns(tbl, order):
@@ -52,33 +152,35 @@ def rename_columns(tbl, mapping={'name': 'Names', 'id': 'IDs',
                 tbl.rename_column(k, v)
 
 
+_badchars = re.compile("[^A-Za-z0-9_]")
+
+
+def fixed_colname(name):
+    """
+    Column name with the bad characters removed, as `fix_bad_colnames` makes
+    it
+    """
+    return _badchars.sub("", name)
+
+
 def fix_bad_colnames(tbl):
     """
     Remove bad characters in column names
     """
-    badchars = re.compile("[^A-Za-z0-9_]")
     for k in tbl.colnames:
-        if badchars.search(k):
-            tbl.rename_column(k, badchars.sub("", k))
-            print(("Renamed {0} to {1}".format(k, badchars.sub("", k))))
+        if _badchars.search(k):
+            tbl.rename_column(k, fixed_colname(k))
+            print(("Renamed {0} to {1}".format(k, fixed_colname(k))))
 
 
 def fix_bad_types(tbl):
     """
-    For all columns that *can* be converted to float, convert them to float
+    Convert in place the string columns that hold numbers or booleans to
+    float, int or bool (see `infer_column_type`).  Columns that already have
+    a numeric or boolean type are left alone.
     """
     log.debug("Fixing bad types")
-    columns = []
-    for columnname, column in list(tbl.columns.items()):
-        try:
-            col = Column(data=column.astype('float'), name=column.name,
-                         unit=column.unit)
-            columns.append(col)
-            log.debug("Converted column {0} from {1} to {2}"
-                      .format(column.name, column, col))
-        except:
-            columns.append(column)
-    return Table(columns)
+    return _convert_columns(tbl, ('float', 'int', 'bool'))
 
 
 def set_units(tbl, units=unit_mapping):
@@ -93,7 +195,7 @@ def set_units(tbl, units=unit_mapping):
         # DEBUG print 'BEFORE unit for',k,":",tbl[k].unit
         if v:
             # only set units if there is a unit to be specified
-            tbl[k].unit = v
+            tbl[k].unit = parse_unit(v)
         # DEBUG print 'AFTER  unit for',k,":",tbl[k].unit
 
 
@@ -107,7 +209,9 @@ def convert_units(tbl, units=unit_mapping):
             raise KeyError("{0} not in table: run `rename_columns` "
                            "first.".format(k))
         log.debug("unit key:{0} value:{1} tbl[k]={2}".format(k, v, tbl[k]))
-        tbl[k] = tbl[k].to(v)
+        factor = conversion_factor(tbl[k].unit or u.dimensionless_unscaled,
+                                   v)
+        tbl[k] = tbl[k].data * factor
         tbl[k].unit = v
 
 
@@ -120,18 +224,66 @@ def add_repeat_column(tbl, value, name):
 
 def append_table(merged_table, table_to_add):
     """
-    Append a new table to the original
-    """
-    for row in table_to_add:
-        merged_table.add_row(row)
+    Append a new table to the original, returning the combined table.
 
-
-def add_generic_ids_if_needed(tbl):
+    All columns are concatenated in one go.  The new values are converted to
+    the units of the original columns where both have units, and are stored
+    with the original column types.  String columns are widened to fit the
+    longest new value.
     """
-    Add numbered IDs if no IDs column is provided
+    nrows = len(merged_table)
+    columns = []
+    for colname in merged_table.colnames:
+        column = merged_table[colname]
+        values = table_to_add[colname]
+        if (column.unit is not None and values.unit is not None and
+                values.unit != column.unit):
+            values = values.data * conversion_factor(values.unit,
+                                                     column.unit)
+
+        new_values = np.asarray(values)
+        dtype = column.dtype
+        if dtype.kind in 'SU':
+            # bring the new values to the kind of the column, to find the
+            # width they need in it
+            if new_values.dtype.kind not in 'SU':
+                new_values = new_values.astype('U')
+            if dtype.kind == 'S' and new_values.dtype.kind == 'U':
+                new_values = np.char.encode(new_values, 'utf-8')
+            elif dtype.kind == 'U' and new_values.dtype.kind == 'S':
+                new_values = np.char.decode(new_values, 'utf-8')
+            dtype = np.result_type(dtype, new_values.dtype)
+
+        data = np.empty(nrows + len(values), dtype=dtype)
+        data[:nrows] = column
+        if isinstance(column, table.MaskedColumn):
+            mask = np.zeros(len(data), dtype='bool')
+            mask[:nrows] = column.mask
+            mask[nrows:] = np.ma.getmaskarray(values)
+            newcol = column.__class__(data=data, mask=mask, name=colname,
+                                      unit=column.unit,
+                                      description=column.description,
+                                      format=column.format,
+                                      meta=column.meta)
+        else:
+            newcol = column.__class__(data=data, name=colname,
+                                      unit=column.unit,
+                                      description=column.description,
+                                      format=column.format,
+                                      meta=column.meta)
+        newcol[nrows:] = new_values
+        columns.append(newcol)
+
+    return Table(columns, meta=merged_table.meta)
+
+
+def add_generic_ids_if_needed(tbl, start=0):
+    """
+    Add numbered IDs, counting from ``start``, if no IDs column is provided
     """
     if 'IDs' not in tbl.colnames:
-        tbl.add_column(table.Column(data=np.arange(len(tbl)), name='IDs'))
+        tbl.add_column(table.Column(data=np.arange(start, start + len(tbl)),
+                                    name='IDs'))
 
 
 def add_is_sim_if_needed(tbl, is_sim=True):
@@ -150,35 +302,61 @@ def add_is_gal_if_needed(tbl, is_gal=True):
         add_repeat_column(tbl, is_gal, 'IsGalactic')
 
 
-def ignore_duplicates(table, duplicates):
+def _as_str(values):
+    values = np.asarray(values)
+    if values.dtype.kind == 'S':
+        return np.char.decode(values, 'utf-8')
+    return values.astype('U')
+
+
+def table_keys(tbl):
+    """
+    Return the (Names, IDs) pair of each row as one string, to be used as the
+    key identifying an entry of the database
+    """
+    names = np.char.strip(_as_str(tbl['Names']))
+    ids = np.char.strip(_as_str(tbl['IDs']))
+    return np.char.add(np.char.add(names, '\t'), ids)
+
+
+class KeyIndex(object):
     """
-    If entries in upload data duplicate entries already in table, ignore them.
-    Needs list of duplicates, which is constructed elsewhere.
+    Sorted (Names, IDs) keys of a table, for checking many keys at once
+    against the table without scanning it
     """
-    to_delete = []
-    for row in table:
-        name = row['Names']
-        id = row['IDs']
-        if id in duplicates:
-            if duplicates[id] == name:
-                to_delete.append(row.index)
 
-    table.remove_rows(to_delete)
+    def __init__(self, tbl):
+        self.keys = np.unique(table_keys(tbl))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def contains(self, keys):
+        """
+        Return a boolean array telling which of ``keys`` are in the index
+        """
+        keys = np.asarray(keys)
+        if len(self.keys) == 0:
+            return np.zeros(keys.shape, dtype='bool')
+        position = np.minimum(np.searchsorted(self.keys, keys),
+                              len(self.keys) - 1)
+        return self.keys[position] == keys
 
 
-def update_duplicates(merged_table, duplicates):
+def find_duplicate_keys(keys):
     """
-    If entries in upload data duplicate entries already in table, remove
-    the versions already in the table. Needs list of duplicates, which is
-    constructed elsewhere.
+    Return the keys (see `table_keys`) that appear more than once
     """
+    keys, counts = np.unique(keys, return_counts=True)
+    return keys[counts > 1]
 
-    to_delete = []
-    for row in merged_table:
-        name = row['Names']
-        id = row['IDs']
-        if id in duplicates:
-            if duplicates[id] == name:
-                to_delete.append(row.index)
 
+def update_duplicates(merged_table, keys):
+    """
+    If entries in upload data duplicate entries already in table, remove
+    the versions already in the table. Needs the keys (see `table_keys`) of the
+    uploaded entries.  Returns the number of rows removed.
+    """
+    to_delete = np.flatnonzero(np.isin(table_keys(merged_table), keys))
     merged_table.remove_rows(to_delete)
+    return len(to_delete)
@@ -1,3 +1,4 @@
+import os
 from warnings import warn
 from textwrap import wrap
 from astropy.io.ascii import ipac,core
@@ -89,8 +90,89 @@ class IpacSpecifiableWidth(ipac.Ipac):
 
         return lines
 
+    def write_rows(self, table, widths):
+        """
+        Write only the data lines of ``table``, with the specified widths
+
+        Parameters
+        ----------
+        table: `~astropy.table.Table`
+            Input table data
+        widths: list
+            A list of integer line widths
+
+        Returns
+        -------
+        lines : list
+            List of strings corresponding to the table rows
+
+        """
+        self.data.fill_values.append((core.masked, 'null'))
+
+        new_cols = list(six.itervalues(table.columns))
+        self.header.cols = new_cols
+        self.data.cols = new_cols
+        self.data._set_fill_values(self.data.cols)
+
+        data_str_vals = list(zip(*self.data.str_vals()))
+
+        lines = []
+        self.data.write(lines, widths, data_str_vals)
+
+        return lines
+
 def ipac_writer(table, outfilename, widths):
     linemaker = IpacSpecifiableWidth()
     lines = linemaker.write(table, widths)
     with open(outfilename, 'w') as f:
         f.write("\n".join(lines))
+
+def read_header_lines(filename):
+    """
+    Return the ``|``-delimited column header lines of an IPAC file
+    """
+    header = []
+    with open(filename) as f:
+        for line in f:
+            if line.startswith('\\'):
+                continue
+            elif line.startswith('|'):
+                header.append(line.rstrip('\n'))
+            else:
+                break
+    return header
+
+def ipac_append(table, outfilename, widths):
+    """
+    Append the rows of ``table`` to an IPAC file written by `ipac_writer` with
+    the same ``widths``, formatting only the new rows.
+
+    The file is left untouched and False is returned if it does not exist or
+    its column header does not match the one `ipac_writer` would write for
+    ``table``; it then has to be written in full.
+    """
+    if not os.path.isfile(outfilename):
+        return False
+
+    header = [line for line in IpacSpecifiableWidth().write(table[:0], widths)
+              if line.startswith('|')]
+    if read_header_lines(outfilename) != header:
+        return False
+
+    lines = IpacSpecifiableWidth().write_rows(table, widths)
+    if not lines:
+        return True
+
+    with open(outfilename, 'rb') as f:
+        f.seek(0, 2)
+        needs_newline = f.tell() > 0
+        if needs_newline:
+            f.seek(-1, 2)
+            needs_newline = f.read(1) != b'\n'
+
+    with open(outfilename, 'a') as f:
+        if needs_newline:
+            f.write("\n")
+        f.write("\n".join(lines))
+
+    return True
@@ -0,0 +1,220 @@
+"""
+Housekeeping of the generated plots and tables.
+
+Every query and upload leaves files behind in the output folders (the mpld3
+and PNG plots, the jsviewer tables and the query results and descriptions).
+Rather than sweeping the folders while serving a request, the files are
+recorded in a manifest when they are made or served, and a background thread
+(`start_janitor`) deletes the least recently used ones whenever they take up
+more than the disk budget.
+
+The manifest is a SQLite table of the path, size and time of last use of each
+artifact, shared by all the server processes.  Files that belong together,
+e.g. the plots and data of one query, are in the same group (see
+`artifact_group`) and are evicted together.  The janitor also rescans the
+output folders every ``scan_interval`` seconds, so that files made by older
+versions of the server or otherwise missing from the manifest are tracked
+(with their modification time as time of last use) and deleted files are
+forgotten.  The number of runs, of evicted files and of bytes reclaimed are
+kept in the same database (`janitor_stats`).
+"""
+
+import os
+import time
+from astropy import log
+from background import connect_database, start_daemon
+
+JANITOR_DATABASE = 'janitor/artifacts.sqlite'
+
+# Groups used less than this many seconds ago are never evicted: their page
+# may still be loading them
+MIN_AGE = 300
+
+janitor_schema = ("CREATE TABLE IF NOT EXISTS artifacts ("
+                  "path TEXT PRIMARY KEY, "
+                  "grp TEXT NOT NULL, "
+                  "size INTEGER NOT NULL, "
+                  "last_used REAL NOT NULL)",
+                  "CREATE INDEX IF NOT EXISTS artifacts_grp "
+                  "ON artifacts (grp)",
+                  "CREATE TABLE IF NOT EXISTS stats ("
+                  "name TEXT PRIMARY KEY, "
+                  "value REAL NOT NULL)")
+
+
+def connect(database=JANITOR_DATABASE):
+    """
+    Open the manifest database, creating it if needed
+    """
+    return connect_database(database, janitor_schema)
+
+
+def artifact_group(path, prefixes=()):
+    """
+    Group of an artifact: its file name without the extension and without
+    the first of ``prefixes`` it starts with.  The outputs of a query, named
+    ``<prefix><key><extension>``, thus share the group ``key``.
+    """
+    name = os.path.splitext(os.path.basename(path))[0]
+    for prefix in prefixes:
+        if name.startswith(prefix) and len(name) > len(prefix):
+            return name[len(prefix):]
+    return name
+
+
+def record_artifacts(paths, prefixes=(), database=JANITOR_DATABASE):
+    """
+    Record that the artifacts at ``paths`` were just made or used.  Missing
+    files are ignored.
+    """
+    now = time.time()
+    rows = []
+    for path in paths:
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            continue
+        rows.append((path, artifact_group(path, prefixes), size, now))
+    if not rows:
+        return
+    connection = connect(database)
+    try:
+        connection.executemany("INSERT OR REPLACE INTO artifacts "
+                               "(path, grp, size, last_used) "
+                               "VALUES (?, ?, ?, ?)", rows)
+    finally:
+        connection.close()
+
+
+def scan_folders(folders, prefixes=(), database=JANITOR_DATABASE):
+    """
+    Bring the manifest in line with the contents of ``folders``: track the
+    files that are not in it yet and forget those that no longer exist
+    """
+    connection = connect(database)
+    try:
+        tracked = set(path for (path,) in
+                      connection.execute("SELECT path FROM artifacts"))
+        found = []
+        for folder in folders:
+            try:
+                entries = list(os.scandir(folder))
+            except OSError:
+                continue
+            for entry in entries:
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                path = os.path.join(folder, entry.name)
+                found.append(path)
+                if path in tracked:
+                    continue
+                stat = entry.stat()
+                connection.execute("INSERT OR IGNORE INTO artifacts "
+                                   "(path, grp, size, last_used) "
+                                   "VALUES (?, ?, ?, ?)",
+                                   (path, artifact_group(path, prefixes),
+                                    stat.st_size, stat.st_mtime))
+        gone = tracked.difference(found)
+        connection.executemany("DELETE FROM artifacts WHERE path = ?",
+                               [(path,) for path in gone])
+    finally:
+        connection.close()
+    log.debug("Janitor scan: {0} files, {1} gone".format(len(found),
+                                                          len(gone)))
+
+
+def _add_stats(connection, **increments):
+    for name, increment in increments.items():
+        connection.execute("INSERT OR IGNORE INTO stats (name, value) "
+                           "VALUES (?, 0)", (name,))
+        connection.execute("UPDATE stats SET value = value + ? "
+                           "WHERE name = ?", (increment, name))
+
+
+def evict(budget, min_age=MIN_AGE, database=JANITOR_DATABASE):
+    """
+    Delete the least recently used groups of artifacts until the tracked
+    artifacts take up no more than ``budget`` bytes.  Returns the number of
+    files deleted and of bytes reclaimed.
+    """
+    connection = connect(database)
+    nfiles, nbytes = 0, 0
+    try:
+        (total,) = connection.execute("SELECT COALESCE(SUM(size), 0) "
+                                      "FROM artifacts").fetchone()
+        if total > budget:
+            groups = connection.execute("SELECT grp, SUM(size), "
+                                        "MAX(last_used) FROM artifacts "
+                                        "GROUP BY grp "
+                                        "ORDER BY MAX(last_used)").fetchall()
+            now = time.time()
+            for group, size, last_used in groups:
+                if total <= budget or now - last_used < min_age:
+                    break
+                paths = [path for (path,) in
+                         connection.execute("SELECT path FROM artifacts "
+                                            "WHERE grp = ?", (group,))]
+                log.debug("Evicting {0} ({1} bytes)".format(group, size))
+                for path in paths:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        # already removed, e.g. by another process
+                        continue
+                    nfiles += 1
+                connection.execute("DELETE FROM artifacts WHERE grp = ?",
+                                   (group,))
+                total -= size
+                nbytes += size
+        _add_stats(connection, runs=1, files_evicted=nfiles,
+                   bytes_reclaimed=nbytes)
+    finally:
+        connection.close()
+    return nfiles, nbytes
+
+
+def janitor_stats(database=JANITOR_DATABASE):
+    """
+    Counts of the janitor: the number and size of the tracked artifacts, and
+    the number of runs, files evicted and bytes reclaimed so far
+    """
+    connection = connect(database)
+    try:
+        stats = {'runs': 0, 'files_evicted': 0, 'bytes_reclaimed': 0}
+        stats.update((name, int(value)) for name, value in
+                     connection.execute("SELECT name, value FROM stats"))
+        stats['tracked_files'], stats['tracked_bytes'] = \
+            connection.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) "
+                               "FROM artifacts").fetchone()
+    finally:
+        connection.close()
+    return stats
+
+
+def run_janitor(folders, budget, prefixes=(), interval=60.,
+                scan_interval=600., database=JANITOR_DATABASE):
+    """
+    Enforce the disk budget every ``interval`` seconds, forever, rescanning
+    the ``folders`` every ``scan_interval`` seconds
+    """
+    last_scan = None
+    while True:
+        try:
+            if last_scan is None or time.time() - last_scan > scan_interval:
+                scan_folders(folders, prefixes, database=database)
+                last_scan = time.time()
+            evict(budget, database=database)
+        except Exception as ex:
+            log.warning("Janitor error: {0}".format(ex))
+        time.sleep(interval)
+
+
+def start_janitor(folders, budget, prefixes=(), interval=60.,
+                  scan_interval=600., database=JANITOR_DATABASE):
+    """
+    Start the janitor in a daemon thread of this process, unless one is
+    already running
+    """
+    return start_daemon('janitor', run_janitor, folders=folders,
+                        budget=budget, prefixes=prefixes, interval=interval,
+                        scan_interval=scan_interval, database=database)
@@ -0,0 +1,222 @@
+"""
+Vectorized selection of rows from the merged table.
+
+The query form specifies a box in (SurfaceDensity, VelocityDispersion, Radius)
+space plus a choice of observed / simulated and Galactic / extragalactic
+entries.  The bounds are converted to the table's units once, and every
+predicate is then evaluated as a numpy boolean mask over whole columns, so no
+per-row Quantity objects are built.
+
+Nothing in here depends on Flask: `parse_query` accepts any mapping with the
+same keys as the query form, e.g. ``request.form`` or a plain dict.
+"""
+
+import numpy as np
+from astropy import units as u
+from ingest_datasets_better import unit_mapping
+from unit_registry import parse_unit, conversion_factor
+
+query_column_names = ['SurfaceDensity', 'VelocityDispersion', 'Radius']
+
+default_flags = {'ShowObs': True, 'ShowSim': True,
+                 'ShowGal': True, 'ShowExgal': True}
+
+
+def parse_query(form):
+    """
+    Read the query bounds and display flags from a query-form mapping.
+
+    The query form always has all the fields, but other clients can leave
+    some out: a column without ``_min`` and ``_max`` is not constrained, a
+    missing limit is open-ended, a missing ``_unit`` means the canonical unit,
+    and missing ``ObsSimBoth`` / ``GalExgalBoth`` select everything.
+
+    Returns
+    -------
+    bounds : dict
+        ``{column name: (min, max)}`` with the limits as Quantities in the
+        canonical units of ``unit_mapping``
+    flags : dict
+        The ``ShowObs``, ``ShowSim``, ``ShowGal`` and ``ShowExgal`` booleans
+    """
+    bounds = {}
+    for colname in query_column_names:
+        if (form.get(colname + '_min') is None and
+                form.get(colname + '_max') is None):
+            continue
+        unit = parse_unit(form.get(colname + '_unit') or
+                          unit_mapping[colname])
+        factor = conversion_factor(unit, unit_mapping[colname])
+        bounds[colname] = tuple(float(form.get(colname + limit, default)) *
+                                factor * unit_mapping[colname]
+                                for limit, default in (('_min', -np.inf),
+                                                       ('_max', np.inf)))
+
+    obssim = form.get('ObsSimBoth', 'IsObsSim')
+    galexgal = form.get('GalExgalBoth', 'IsGalExgal')
+    flags = {'ShowObs': obssim in ('IsObserved', 'IsObsSim'),
+             'ShowSim': obssim in ('IsSimulated', 'IsObsSim'),
+             'ShowGal': galexgal in ('IsGalactic', 'IsGalExgal'),
+             'ShowExgal': galexgal in ('IsExtragalactic', 'IsGalExgal')}
+
+    return bounds, flags
+
+
+def flag_values(column):
+    """
+    Return a boolean array for a column of booleans or of 'True'/'False'
+    strings
+    """
+    values = np.asarray(column)
+    if values.dtype.kind == 'b':
+        return values
+    if values.dtype.kind == 'S':
+        return np.char.strip(values) == b'True'
+    return np.char.strip(values.astype('U')) == 'True'
+
+
+def range_mask(column, vmin, vmax):
+    """
+    Select the entries of ``column`` strictly between ``vmin`` and ``vmax``.
+    The limits are converted to the column's unit once.
+    """
+    vmin, vmax = _bounds_in_unit(vmin, vmax, column.unit)
+    values = np.asarray(column)
+    return (values > vmin) & (values < vmax)
+
+
+def _bounds_in_unit(vmin, vmax, unit):
+    vmin, vmax = u.Quantity(vmin), u.Quantity(vmax)
+    if unit is not None:
+        return (vmin.value * conversion_factor(vmin.unit, unit),
+                vmax.value * conversion_factor(vmax.unit, unit))
+    return vmin.value, vmax.value
+
+
+class RangeIndex(object):
+    """
+    Sorted per-column index for the range predicates of a query.
+
+    Each indexed column is argsorted once; a ``(min, max)`` range is then
+    answered with two binary searches.  A box query takes the candidates from
+    the most selective column and checks the remaining ranges on those rows
+    only, so its cost scales with the number of candidates rather than with
+    the size of the table.
+
+    The index describes the table it was built from and must be rebuilt when
+    rows are added to it.
+    """
+
+    def __init__(self, table, colnames=query_column_names):
+        self.nrows = len(table)
+        self.units = {}
+        self.values = {}
+        self.order = {}
+        self.sorted_values = {}
+        for colname in colnames:
+            values = np.asarray(table[colname], dtype='float')
+            order = np.argsort(values, kind='mergesort')
+            self.units[colname] = table[colname].unit
+            self.values[colname] = values
+            self.order[colname] = order
+            self.sorted_values[colname] = values[order]
+
+    def candidates(self, colname, vmin, vmax):
+        """
+        Return the (unsorted) row indices with ``vmin < value < vmax``
+        """
+        vmin, vmax = _bounds_in_unit(vmin, vmax, self.units[colname])
+        sorted_values = self.sorted_values[colname]
+        start = np.searchsorted(sorted_values, vmin, side='right')
+        stop = np.searchsorted(sorted_values, vmax, side='left')
+        return self.order[colname][start:max(start, stop)]
+
+    def query(self, bounds):
+        """
+        Return the sorted indices of the rows that fall inside all ``bounds``
+        """
+        if not bounds:
+            return np.arange(self.nrows)
+
+        candidates = {colname: self.candidates(colname, vmin, vmax)
+                      for colname, (vmin, vmax) in bounds.items()}
+        best = min(candidates, key=lambda colname: len(candidates[colname]))
+        rows = candidates[best]
+        for colname, (vmin, vmax) in bounds.items():
+            if colname == best or len(rows) == 0:
+                continue
+            vmin, vmax = _bounds_in_unit(vmin, vmax, self.units[colname])
+            values = self.values[colname][rows]
+            rows = rows[(values > vmin) & (values < vmax)]
+
+        return np.sort(rows)
+
+
+def query_rows(table, bounds, index=None, ShowObs=True, ShowSim=True,
+               ShowGal=True, ShowExgal=True):
+    """
+    Compute the indices of the rows in ``table`` that satisfy the query.
+
+    If a `RangeIndex` built from ``table`` is given, it is used to answer the
+    range part of the query.
+    """
+    if index is None:
+        mask = np.ones(len(table), dtype='bool')
+        for colname, (vmin, vmax) in bounds.items():
+            mask &= range_mask(table[colname], vmin, vmax)
+        rows = np.flatnonzero(mask)
+    else:
+        rows = index.query(bounds)
+
+    if not (ShowObs and ShowSim):
+        is_sim = flag_values(table['IsSimulated'][rows])
+        if not ShowObs:
+            rows = rows[is_sim]
+        if not ShowSim:
+            rows = rows[~is_sim]
+
+    if not (ShowGal and ShowExgal):
+        is_gal = flag_values(table['IsGalactic'][rows])
+        if not ShowGal:
+            rows = rows[~is_gal]
+        if not ShowExgal:
+            rows = rows[is_gal]
+
+    return rows
+
+
+def query_table(table, bounds, index=None, **flags):
+    """
+    Return the subset of ``table`` matching the query as a new table
+    """
+    return table[query_rows(table, bounds, index=index, **flags)]
+
+
+def table_columns(table, colnames=None):
+    """
+    Convert the columns ``colnames`` (default: all) of a table to plain lists
+    that can be serialized as JSON.  Returns ``{'columns': {name: values},
+    'units': {name: unit}}``; masked and non-finite values become None.
+    """
+    if colnames is None:
+        colnames = table.colnames
+
+    columns = {}
+    units = {}
+    for colname in colnames:
+        column = table[colname]
+        values = np.asarray(column)
+        if values.dtype.kind == 'S':
+            values = np.char.decode(values, 'utf-8')
+        elif values.dtype.kind == 'O':
+            values = values.astype('U')
+        missing = np.ma.getmaskarray(column).copy()
+        if values.dtype.kind == 'f':
+            missing |= ~np.isfinite(values)
+        values = values.astype(object)
+        values[missing] = None
+        columns[colname] = values.tolist()
+        units[colname] = (None if column.unit is None
+                          else column.unit.to_string())
+
+    return {'columns': columns, 'units': units}
@@ -0,0 +1,59 @@
+"""
+Cache of rendered query results.
+
+The plots (mpld3 HTML and PNG) and the JSON data produced for a query only
+depend on the query and on the version of the database, so they are named
+after a hash of both (`query_key`) instead of after the time of the request.
+A repeated query finds its artifacts on disk and serves them as they are.
+
+The artifacts of a query are touched whenever they are served; keeping them
+under a size budget is left to the `janitor`, which deletes the least recently
+used queries first.
+"""
+
+import os
+import json
+import hashlib
+from ingest_datasets_better import unit_mapping
+
+KEY_LENGTH = 20
+
+
+def query_key(bounds, flags, version):
+    """
+    Hash a query into a key for its rendered artifacts.
+
+    Parameters
+    ----------
+    bounds : dict
+        ``{column name: (min, max)}`` as returned by
+        `~query_engine.parse_query`.  The limits are normalized to the
+        canonical units, so equivalent queries share a key.
+    flags : dict
+        The display flags of the query
+    version : str
+        The version of the database, e.g.
+        `~table_store.get_table_version`
+    """
+    normalized = {'bounds': {colname: ['{0:.12g}'.format(
+                                           limit.to(unit_mapping[colname])
+                                           .value)
+                                       for limit in limits]
+                             for colname, limits in bounds.items()},
+                  'flags': {name: bool(value)
+                            for name, value in flags.items()},
+                  'version': version}
+    text = json.dumps(normalized, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:KEY_LENGTH]
+
+
+def touch_artifacts(paths):
+    """
+    Return True if all the artifacts exist, marking them as just used
+    """
+    try:
+        for path in paths:
+            os.utime(path, None)
+    except OSError:
+        return False
+    return True
@@ -51,6 +51,71 @@ label_dict_png = \
      'Radius': '$R$ [pc]'}
 
 
+plot_outputs = ('html', 'png')
+
+# Number of hexagons across the density map of large plots
+density_gridsize = 50
+
+
+def thin_points(x, y, groups, max_points, bins=None):
+    """
+    Select at most ``max_points`` of a set of points, keeping the outliers
+    and the appearance of each group of points.
+
+    The plane is divided in a grid of ``bins`` by ``bins`` cells, and one point
+    of each group is kept in each cell: isolated points are always kept, and
+    dense areas are thinned out.  The grid is made coarser until few enough
+    points are left.  Returns the sorted indices of the points to keep.
+    """
+    if bins is None:
+        bins = max(int(np.sqrt(max_points)), 1)
+    x = np.asarray(x, dtype='float')
+    y = np.asarray(y, dtype='float')
+
+    def cell(values, bins):
+        vmin, vmax = values.min(), values.max()
+        if vmax == vmin:
+            return np.zeros(len(values), dtype='int')
+        return np.minimum(((values - vmin) / (vmax - vmin) * bins)
+                          .astype('int'), bins - 1)
+
+    while True:
+        cells = (np.asarray(groups) * bins + cell(x, bins)) * bins + \
+            cell(y, bins)
+        keep = np.sort(np.unique(cells, return_index=True)[1])
+        if len(keep) <= max_points or bins == 1:
+            break
+        bins = max(min(bins - 1, int(bins * 0.8)), 1)
+
+    return keep[:max_points]
+
+
+def tooltip_labels(table, colnames=None):
+    """
+    Build the HTML tooltip of every row of a table, showing the values of the
+    columns ``colnames`` (default: all columns) that the table has.  Each
+    column is formatted once for all rows; returns an array of strings.
+    """
+    if colnames is None:
+        colnames = table.colnames
+    colnames = [colname for colname in colnames if colname in table.colnames]
+
+    labels = np.zeros(len(table), dtype='U1')
+    for colname in colnames:
+        column = table[colname]
+        values = np.asarray(column)
+        if values.dtype.kind == 'S':
+            values = np.char.decode(values, 'utf-8')
+        else:
+            values = values.astype('U')
+        if np.ma.is_masked(column):
+            values = np.where(np.ma.getmaskarray(column), '--', values)
+        labels = np.char.add(labels, '<div>{0}</div> <div>'.format(colname))
+        labels = np.char.add(labels, values)
+        labels = np.char.add(labels, '</div> \n ')
+    return labels
+
+
 def plotData_Sigma_sigma(NQuery, table, FigureStrBase,
                          SurfMin=1e-1*u.M_sun/u.pc**2,
                          SurfMax=1e5*u.M_sun/u.pc**2,
@@ -95,7 +160,8 @@ def plotData(NQuery, input_table, FigureStrBase, html_dir=None, png_dir=None,
              zvariable='Radius',
              xMin=None, xMax=None, yMin=None, yMax=None, zMin=None, zMax=None,
              interactive=False, show_log=True, min_marker_width=3,
-             max_marker_width=0.05):
+             max_marker_width=0.05, tooltip_columns=None,
+             outputs=plot_outputs, max_points=None):
     """
     This is where documentation needs to be added
 
@@ -119,6 +185,16 @@ def plotData(NQuery, input_table, FigureStrBase, html_dir=None, png_dir=None,
         Sets the pixel width of the smallest marker to be plotted. If <1,
         it is interpreted to be a fraction of the total pixels along the
         shortest axis.
+    tooltip_columns : list, optional
+        The columns shown in the tooltip of each point.  Defaults to all
+        columns of the table.
+    outputs : sequence, optional
+        Which of the outputs to make: 'html' (interactive mpld3 plot) and/or
+        'png'.  The returned filename of an output that was not made is None.
+    max_points : int, optional
+        If there are more points to plot than this, plot the density of all
+        the points, and only a selection of at most ``max_points`` of them
+        as individual points (see `thin_points`).
 
     """
     if len(input_table) == 0:
@@ -197,7 +273,44 @@ def plotData(NQuery, input_table, FigureStrBase, html_dir=None, png_dir=None,
     else:
         log.debug("Found {0} points to plot".format(nptstoplot))
 
-    UniqueAuthor = list(set(Author[Use]))
+    # Group the points to plot by author, observations before simulations,
+    # so that each point is assigned to its group once
+    use_rows = np.flatnonzero(Use)
+    author_names = np.asarray(Author)[use_rows]
+    if author_names.dtype.kind == 'S':
+        # the labels of the legend must be str for mpld3 and matplotlib
+        author_names = np.char.decode(author_names, 'utf-8')
+    UniqueAuthor, author_index = np.unique(author_names, return_inverse=True)
+    author_index = author_index.ravel()
+    is_sim = np.asarray(IsSim, dtype='bool')[use_rows]
+    order = np.lexsort((is_sim, author_index))
+    rows = use_rows[order]
+    groups = author_index[order] * 2 + is_sim[order]
+
+    if show_log:
+        plot_x = np.log10(np.asarray(x_ax))
+        plot_y = np.log10(np.asarray(y_ax))
+    else:
+        plot_x = np.asarray(x_ax)
+        plot_y = np.asarray(y_ax)
+
+    # Too many points for the browser: show a density map of all of them,
+    # and only a thinned-out selection as individual points
+    thinned = max_points is not None and len(rows) > max_points
+    if thinned:
+        ax.hexbin(plot_x[rows], plot_y[rows], gridsize=density_gridsize,
+                  mincnt=1, cmap='Greys', bins='log', zorder=0)
+        keep = thin_points(plot_x[rows], plot_y[rows], groups, max_points)
+        rows = rows[keep]
+        groups = groups[keep]
+        ax.text(0.98, 0.02, "{0} of {1} points shown"
+                .format(len(rows), nptstoplot),
+                transform=ax.transAxes, horizontalalignment='right')
+        log.debug("Thinned {0} points to {1}".format(nptstoplot, len(rows)))
+
+    group_starts = np.concatenate([[0], np.flatnonzero(np.diff(groups)) + 1])
+    group_stops = np.concatenate([group_starts[1:], [len(rows)]])
+    UniqueAuthor = UniqueAuthor.tolist()
     NUniqueAuthor = len(UniqueAuthor)
 
     colors = list(matplotlib.cm.jet(np.linspace(0, 1, NUniqueAuthor)))
@@ -221,83 +334,50 @@ def plotData(NQuery, input_table, FigureStrBase, html_dir=None, png_dir=None,
     if min_marker_width < 1:
         min_marker_width *= min_axis_size
 
+    log_z = np.log10(np.asarray(z_ax))
     marker_conversion = max_marker_width / \
-        (np.log10(z_ax[Use].max())-np.log10(z_ax[Use].min()))
+        (log_z[use_rows].max() - log_z[use_rows].min())
 
     marker_widths = (marker_conversion *
-                     (np.log10(np.array(z_ax))-np.log10(z_ax[Use].min())) +
+                     (log_z - log_z[use_rows].min()) +
                      min_marker_width)
 
     marker_sizes = marker_widths**2
 
+    # the tooltips and mpld3 plugins are only needed for the html output
+    make_html = 'html' in outputs or interactive
+    if make_html:
+        labels = tooltip_labels(d[rows], tooltip_columns)
+
     scatters = []
 
     markers = ['o', 's']
-    for iAu, color in zip(UniqueAuthor, colors):
-        ObsPlot = ((Author == iAu) & (~IsSim)) & Use
-        SimPlot = ((Author == iAu) & (IsSim)) & Use
-
-        if show_log:
-            plot_x = np.log10(x_ax)
-            plot_y = np.log10(y_ax)
-
-        if any(ObsPlot):
-            # Change to logs on next commit
-            scatter = \
-                ax.scatter(plot_x[ObsPlot], plot_y[ObsPlot], marker=markers[0],
-                           s=marker_sizes[ObsPlot],
-                           color=color, alpha=0.5, edgecolors='k',
-                           label=iAu)
-
-            scatters.append(scatter)
-
-            labels = []
-
-            for row in d[ObsPlot]:
-                colnames = ['<div>{title}</div>'.format(title=col)
-                            for col in row.colnames]
-                values = ['<div>{title}</div>'.format(title=str(val))
-                          for val in row]
-
-                label = ""
-
-                for col, val in zip(colnames, values):
-                    label += col+" "+val+" \n "
-
-                labels.append(label)
-
-            tooltip = plugins.PointHTMLTooltip(scatter, labels,
-                                               voffset=10, hoffset=10)
-            plugins.connect(figure, tooltip)
-
-        if any(SimPlot):
-            # Change to logs on next commit
-            scatter = \
-                ax.scatter(plot_x[SimPlot], plot_y[SimPlot], marker=markers[1],
-                           s=marker_sizes[SimPlot],
-                           color=color, alpha=0.5, edgecolors='k',
-                           label=iAu)
-
-            scatters.append(scatter)
-
-            labels = []
-
-            for row in d[SimPlot]:
-                colnames = ['<div>{title}</div>'.format(title=col)
-                            for col in row.colnames]
-                values = ['<div>{title}</div>'.format(title=str(val))
-                          for val in row]
-
-                label = ""
-
-                for col, val in zip(colnames, values):
-                    label += col+" "+val+" \n "
-
-                labels.append(label)
-
-            tooltip = plugins.PointHTMLTooltip(scatter, labels,
+    for start, stop in zip(group_starts, group_stops):
+        group_rows = rows[start:stop]
+        iAu = UniqueAuthor[groups[start] // 2]
+        color = colors[groups[start] // 2]
+        group_is_sim = int(groups[start] % 2)
+
+        scatter = \
+            ax.scatter(plot_x[group_rows], plot_y[group_rows],
+                       marker=markers[group_is_sim],
+                       s=marker_sizes[group_rows],
+                       color=color, alpha=0.5, edgecolors='k',
+                       label=iAu)
+
+        scatters.append(scatter)
+
+        if not make_html:
+            continue
+        if group_is_sim:
+            tooltip = plugins.PointHTMLTooltip(scatter,
+                                               labels[start:stop].tolist(),
                                                voffset=10, hoffset=10, css=css)
-            plugins.connect(figure, tooltip)
+        else:
+            tooltip = plugins.PointHTMLTooltip(scatter,
+                                               labels[start:stop].tolist(),
+                                               voffset=10, hoffset=10)
+        plugins.connect(figure, tooltip)
 
     ax.set_xlabel(label_dict_html[xvariable], fontsize=16)
     ax.set_ylabel(label_dict_html[yvariable], fontsize=16)
@@ -322,7 +402,7 @@ def plotData(NQuery, input_table, FigureStrBase, html_dir=None, png_dir=None,
     # ax.legend(UniqueAuthor, loc='center left', bbox_to_anchor=(1.0, 0.5),
     #           prop={'size':12}, markerscale = .7, scatterpoints = 1)
 
-    if hasattr(mpld3.plugins, 'InteractiveLegendPlugin'):
+    if make_html and hasattr(mpld3.plugins, 'InteractiveLegendPlugin'):
         plugins.connect(figure,
                         plugins.InteractiveLegendPlugin(scatters,
                                                         UniqueAuthor,
@@ -343,7 +423,7 @@ def plotData(NQuery, input_table, FigureStrBase, html_dir=None, png_dir=None,
         fake_z_marker_width = np.array([max_z, mid_z, min_z])
 
     fake_marker_sizes = (marker_conversion *
-                         (fake_z_marker_width-np.log10(z_ax[Use].min())) +
+                         (fake_z_marker_width - log_z[use_rows].min()) +
                          min_marker_width)**2
 
     # Set the axis fraction to plot the points at. Adjust if the largest
@@ -380,12 +460,14 @@ def plotData(NQuery, input_table, FigureStrBase, html_dir=None, png_dir=None,
     if png_dir is None:
         png_dir = ""
 
-    html_file = os.path.join(html_dir, FigureStrBase+NQuery+'.html')
-    png_file = os.path.join(png_dir, FigureStrBase+NQuery+".png")
+    html_file = None
+    png_file = None
 
-    html = mpld3.fig_to_html(figure)
-    with open(html_file, 'w') as f:
-       f.write(html)
+    if 'html' in outputs:
+        html_file = os.path.join(html_dir, FigureStrBase+NQuery+'.html')
+        html = mpld3.fig_to_html(figure)
+        with open(html_file, 'w') as f:
+           f.write(html)
 
     if interactive:
         # from matplotlib import pyplot as plt
@@ -394,6 +476,9 @@ def plotData(NQuery, input_table, FigureStrBase, html_dir=None, png_dir=None,
 
         mpld3.show()
 
+    if 'png' not in outputs:
+        return html_file, png_file
+
     # Clear out the plugins
     plugins.clear(figure)
 
@@ -410,6 +495,7 @@ def plotData(NQuery, input_table, FigureStrBase, html_dir=None, png_dir=None,
                        handlelength=4)
     legend.draw_frame(False)
 
+    png_file = os.path.join(png_dir, FigureStrBase+NQuery+".png")
     figure.savefig(png_file, bbox_inches='tight', dpi=150)
     # figure.savefig(FigureStrBase+NQuery+'.pdf',bbox_inches='tight',dpi=150)
 
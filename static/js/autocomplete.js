@@ -1,13 +1,13 @@
 $SCRIPT_ROOT = {{ request.script_root|tojson|safe }};
 
 $(function() {
-    $.ajax({
-        url: '{{ url_for(".autocomplete_units") }}'
-    }).done(function (data) {
-        $('.units').autocomplete({
-            source: data.json_list,
-            minLength: 2
-        });
+    $('.units').autocomplete({
+        source: function (request, response) {
+            $.getJSON('{{ url_for(".autocomplete_units") }}',
+                      {term: request.term},
+                      function (data) { response(data.json_list); });
+        },
+        minLength: 2
     });
 });
 
@@ -0,0 +1,247 @@
+"""
+A small persistent job queue for the slow part of a submission.
+
+Committing an upload to the ``database`` and ``uploads`` repositories, pushing
+the branches, opening the pull requests and registering the submitter's
+e-mail can take many seconds.  Instead of doing that inside the HTTP request,
+`set_columns` queues a job and returns straight away; a background worker
+thread picks the job up and records the outcome, which the client can poll.
+
+Jobs are kept in a SQLite file so that they survive restarts and can be shared
+between several server processes without any outside service: claiming jobs
+happens in a single transaction so that a job is only ever run by one worker.
+
+Job kinds registered with a ``batch_window`` are coalesced: the first queued
+job of that kind is held back until it is ``batch_window`` seconds old, and
+then every queued job of the kind is handed to the handler at once.  This is
+how bursts of uploads end up in a single database commit.
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import traceback
+from astropy import log
+from background import connect_database, start_daemon
+
+JOB_FOLDER = 'jobs/'
+JOB_DATABASE = os.path.join(JOB_FOLDER, 'jobs.sqlite')
+
+# Jobs still marked as running this many seconds after they were claimed were
+# left behind by a worker that crashed or was restarted
+STALE_JOB_AGE = 3600
+
+# Job handlers, by job kind, as ``(handler, batch_window)`` tuples.  A handler
+# is called as ``handler(job_id, payload)`` and returns a JSON-serializable
+# result; a batch handler is called as ``handler(job_ids, payloads)`` and
+# returns a list of results in the same order.  A batch handler reports that
+# some of the jobs failed by returning exceptions as their results.
+handlers = {}
+
+job_schema = ("CREATE TABLE IF NOT EXISTS jobs ("
+              "id TEXT PRIMARY KEY, "
+              "kind TEXT NOT NULL, "
+              "status TEXT NOT NULL, "
+              "payload TEXT, "
+              "result TEXT, "
+              "error TEXT, "
+              "traceback TEXT, "
+              "created REAL, "
+              "updated REAL)",)
+
+
+def connect(database=JOB_DATABASE):
+    """
+    Open the job database, creating it if needed
+    """
+    return connect_database(database, job_schema, row_factory=sqlite3.Row)
+
+
+def register_handler(kind, handler, batch_window=None):
+    """
+    Register the function that runs jobs of the given kind.  If
+    ``batch_window`` (in seconds) is given, jobs of this kind are run in
+    batches.
+    """
+    handlers[kind] = (handler, batch_window)
+
+
+def submit_job(kind, payload, database=JOB_DATABASE):
+    """
+    Queue a job and return its ID
+    """
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    connection = connect(database)
+    try:
+        connection.execute("INSERT INTO jobs (id, kind, status, payload, "
+                           "created, updated) VALUES (?, ?, 'queued', ?, ?, ?)",
+                           (job_id, kind, json.dumps(payload), now, now))
+    finally:
+        connection.close()
+    log.debug("Queued {0} job {1}".format(kind, job_id))
+    return job_id
+
+
+def get_job(job_id, database=JOB_DATABASE):
+    """
+    Return the status of a job as a dictionary, or None if it does not exist.
+    The payload is not included since it may contain private data.
+    """
+    connection = connect(database)
+    try:
+        row = connection.execute("SELECT * FROM jobs WHERE id = ?",
+                                 (job_id,)).fetchone()
+    finally:
+        connection.close()
+    if row is None:
+        return None
+    return {'id': row['id'],
+            'kind': row['kind'],
+            'status': row['status'],
+            'result': (json.loads(row['result'])
+                       if row['result'] is not None else None),
+            'error': row['error'],
+            'created': row['created'],
+            'updated': row['updated']}
+
+
+def claim_next_jobs(database=JOB_DATABASE):
+    """
+    Mark the next runnable job (or batch of jobs) as running and return
+    ``(kind, job_ids, payloads)``, or None if nothing is ready to run
+    """
+    now = time.time()
+    connection = connect(database)
+    try:
+        connection.execute("BEGIN IMMEDIATE")
+        queued = connection.execute("SELECT id, kind, payload, created "
+                                    "FROM jobs WHERE status = 'queued' "
+                                    "ORDER BY created").fetchall()
+        claimed = None
+        for row in queued:
+            batch_window = handlers.get(row['kind'], (None, None))[1]
+            if batch_window is None:
+                claimed = row['kind'], [row]
+                break
+            elif now - row['created'] >= batch_window:
+                claimed = row['kind'], [other for other in queued
+                                        if other['kind'] == row['kind']]
+                break
+
+        if claimed is not None:
+            kind, rows = claimed
+            connection.executemany("UPDATE jobs SET status = 'running', "
+                                   "updated = ? WHERE id = ?",
+                                   [(now, row['id']) for row in rows])
+        connection.execute("COMMIT")
+    except Exception:
+        connection.execute("ROLLBACK")
+        raise
+    finally:
+        connection.close()
+
+    if claimed is None:
+        return None
+    return (kind, [row['id'] for row in rows],
+            [json.loads(row['payload']) for row in rows])
+
+
+def requeue_stale_jobs(max_age=STALE_JOB_AGE, database=JOB_DATABASE):
+    """
+    Put the jobs that have been running for more than ``max_age`` seconds
+    back in the queue, and return how many there were
+    """
+    connection = connect(database)
+    try:
+        cursor = connection.execute("UPDATE jobs SET status = 'queued', "
+                                    "updated = ? WHERE status = 'running' "
+                                    "AND updated < ?",
+                                    (time.time(), time.time() - max_age))
+        count = cursor.rowcount
+    finally:
+        connection.close()
+    if count:
+        log.warning("Requeued {0} stale running job(s)".format(count))
+    return count
+
+
+def finish_job(job_id, result=None, error=None, tb=None,
+               database=JOB_DATABASE):
+    """
+    Record the outcome of a job.  The payload is dropped once the job is done.
+    """
+    status = 'failed' if error is not None else 'done'
+    connection = connect(database)
+    try:
+        connection.execute("UPDATE jobs SET status = ?, result = ?, error = ?,"
+                           " traceback = ?, payload = NULL, updated = ? "
+                           "WHERE id = ?",
+                           (status, json.dumps(result), error, tb,
+                            time.time(), job_id))
+    finally:
+        connection.close()
+
+
+def run_next_job(database=JOB_DATABASE):
+    """
+    Run the next queued job or batch of jobs, if there is one.  Returns the
+    list of job IDs that were run, or None.
+    """
+    claimed = claim_next_jobs(database)
+    if claimed is None:
+        return None
+    kind, job_ids, payloads = claimed
+    handler, batch_window = handlers[kind]
+    log.debug("Running {0} job(s) {1}".format(kind, ", ".join(job_ids)))
+    try:
+        if batch_window is None:
+            results = [handler(job_ids[0], payloads[0])]
+        else:
+            results = handler(job_ids, payloads)
+    except Exception as ex:
+        log.warning("Job(s) {0} failed: {1}".format(", ".join(job_ids), ex))
+        tb = traceback.format_exc()
+        for job_id in job_ids:
+            finish_job(job_id, error=str(ex), tb=tb, database=database)
+    else:
+        for job_id, result in zip(job_ids, results):
+            if isinstance(result, Exception):
+                tb = "".join(traceback.format_exception(type(result), result,
+                                                        result.__traceback__))
+                finish_job(job_id, error=str(result), tb=tb,
+                           database=database)
+            else:
+                finish_job(job_id, result=result, database=database)
+    return job_ids
+
+
+def run_worker(poll_interval=1.0, database=JOB_DATABASE):
+    """
+    Run queued jobs forever, polling for new ones every ``poll_interval``
+    seconds when the queue is empty.  Jobs left running by an earlier worker
+    are queued again first.
+    """
+    try:
+        requeue_stale_jobs(database=database)
+    except Exception as ex:
+        log.warning("Could not requeue stale jobs: {0}".format(ex))
+    while True:
+        try:
+            job_ids = run_next_job(database)
+        except Exception as ex:
+            log.warning("Submission worker error: {0}".format(ex))
+            job_ids = None
+        if job_ids is None:
+            time.sleep(poll_interval)
+
+
+def start_worker(poll_interval=1.0, database=JOB_DATABASE):
+    """
+    Start the worker in a daemon thread of this process, unless one is
+    already running
+    """
+    return start_daemon('submission-worker', run_worker,
+                        poll_interval=poll_interval, database=database)
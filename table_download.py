@@ -0,0 +1,167 @@
+"""
+Streamed downloads of query results.
+
+A download is produced from the rows selected by a query as it is sent, a
+chunk of rows at a time, so nothing is written to disk and only one chunk of
+formatted text is held in memory however large the result is.
+
+Every format is built from astropy's own writers:
+
+* CSV and ECSV: the header is written once, from an empty copy of the table,
+  and stripped from the output of every chunk.
+* IPAC: the column widths are worked out from the column types, wide enough
+  for any value, so that all the rows line up under the header (see
+  `ipac_writer`).
+* FITS: the binary table header is written with the final number of rows,
+  followed by the raw rows of each chunk and the padding of the last block.
+"""
+
+import io
+import zlib
+import numpy as np
+from astropy.io import fits
+from astropy.table import MaskedColumn
+from ipac_writer import IpacSpecifiableWidth
+
+DOWNLOAD_CHUNK_ROWS = 10000
+
+# MIME type and file extension of each download format
+download_formats = {'ipac': ('text/plain', '.ipac'),
+                    'csv': ('text/csv', '.csv'),
+                    'ecsv': ('text/plain', '.ecsv'),
+                    'fits': ('application/fits', '.fits')}
+
+astropy_formats = {'csv': 'ascii.csv', 'ecsv': 'ascii.ecsv'}
+
+FITS_BLOCK = 2880
+
+# Width of the longest formatted value of each numeric kind of column, e.g.
+# -2.2250738585072014e-308 for float64
+numeric_widths = {'b': len('False'), 'f': 24,
+                  'i': len(str(np.iinfo('int64').min)),
+                  'u': len(str(np.iinfo('uint64').max))}
+
+
+def iter_row_chunks(table, rows, chunk_rows=DOWNLOAD_CHUNK_ROWS):
+    """
+    Iterate over the ``rows`` of ``table`` in tables of ``chunk_rows`` rows
+    """
+    for start in range(0, len(rows), chunk_rows):
+        yield table[rows[start:start + chunk_rows]]
+
+
+def _write_text(table, dataformat):
+    buf = io.StringIO()
+    table.write(buf, format=astropy_formats[dataformat])
+    return buf.getvalue()
+
+
+def stream_text(table, rows, dataformat, chunk_rows=DOWNLOAD_CHUNK_ROWS):
+    """
+    Stream the selected rows as CSV or ECSV text
+    """
+    header = _write_text(table[rows[:0]], dataformat)
+    yield header
+    for chunk in iter_row_chunks(table, rows, chunk_rows):
+        text = _write_text(chunk, dataformat)
+        if not text.startswith(header):
+            raise ValueError("The {0} header of a chunk differs from that of "
+                             "the table".format(dataformat))
+        yield text[len(header):]
+
+
+def ipac_widths(table, rows):
+    """
+    Widths of the IPAC columns for the ``rows`` of ``table``, wide enough for
+    the header and for any value of each column.  The values are not
+    formatted to find them, except for the columns that have their own
+    ``format``.
+    """
+    empty = table[rows[:0]]
+    # an empty table is written with the widths of its header
+    IpacSpecifiableWidth().write(empty)
+    widths = []
+    for colname, column in table.columns.items():
+        kind = column.dtype.kind
+        if column.info.format is None and kind == 'U':
+            width = column.dtype.itemsize // 4
+        elif column.info.format is None and kind == 'S':
+            width = column.dtype.itemsize
+        elif column.info.format is None and kind in numeric_widths:
+            width = numeric_widths[kind]
+        else:
+            # columns with their own format, or of any other kind, are
+            # formatted to find out
+            selected = column[rows]
+            width = max([len(value) for value in
+                         selected.info.iter_str_vals()] or [0])
+        if isinstance(column, MaskedColumn):
+            width = max(width, len('null'))
+        widths.append(max(width, empty[colname].headwidth))
+    return widths
+
+
+def stream_ipac(table, rows, chunk_rows=DOWNLOAD_CHUNK_ROWS):
+    """
+    Stream the selected rows as an IPAC table
+    """
+    widths = ipac_widths(table, rows)
+    header = IpacSpecifiableWidth().write(table[rows[:0]], widths)
+    yield "\n".join(header) + "\n"
+    for chunk in iter_row_chunks(table, rows, chunk_rows):
+        yield "\n".join(IpacSpecifiableWidth().write_rows(chunk, widths)) + \
+            "\n"
+
+
+def stream_fits(table, rows, chunk_rows=DOWNLOAD_CHUNK_ROWS):
+    """
+    Stream the selected rows as a FITS file with one binary table extension
+    """
+    buf = io.BytesIO()
+    fits.PrimaryHDU().writeto(buf)
+    yield buf.getvalue()
+
+    hdu = fits.table_to_hdu(table[rows[:0]])
+    hdu.header['NAXIS2'] = len(rows)
+    yield hdu.header.tostring().encode('ascii')
+
+    nbytes = 0
+    for chunk in iter_row_chunks(table, rows, chunk_rows):
+        chunk_hdu = fits.table_to_hdu(chunk)
+        buf = io.BytesIO()
+        fits.HDUList([fits.PrimaryHDU(), chunk_hdu]).writeto(buf)
+        start = FITS_BLOCK + len(chunk_hdu.header.tostring())
+        size = chunk_hdu.header['NAXIS1'] * len(chunk)
+        nbytes += size
+        yield buf.getvalue()[start:start + size]
+
+    if nbytes % FITS_BLOCK:
+        yield b'\0' * (FITS_BLOCK - nbytes % FITS_BLOCK)
+
+
+def stream_table(table, rows, dataformat, chunk_rows=DOWNLOAD_CHUNK_ROWS):
+    """
+    Stream the ``rows`` (indices) of ``table`` in one of the
+    ``download_formats``, as bytes
+    """
+    rows = np.asarray(rows)
+    if dataformat == 'fits':
+        return stream_fits(table, rows, chunk_rows)
+    if dataformat == 'ipac':
+        text = stream_ipac(table, rows, chunk_rows)
+    else:
+        text = stream_text(table, rows, dataformat, chunk_rows)
+    return (part.encode('utf-8') for part in text)
+
+
+def gzip_stream(parts, compresslevel=6):
+    """
+    Compress a stream of bytes into a gzip stream
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED,
+                                  16 + zlib.MAX_WBITS)
+    for part in parts:
+        compressed = compressor.compress(part)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
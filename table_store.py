@@ -0,0 +1,251 @@
+"""
+Process-wide store for the merged database table.
+
+Parsing ``merged_table.ipac`` is by far the most expensive part of serving a
+query, so the table is read once per process and kept in memory.  The cached
+copy is keyed on the file's modification time and size, so anything that
+rewrites the file (an upload, ``git pull`` in ``/update_database``) triggers a
+reload on the next access.
+
+A `~query_engine.RangeIndex` over the query columns and a
+`~ingest_datasets_better.KeyIndex` of the (Names, IDs) pairs are built at the
+same time as the table is loaded and are dropped together with it.
+
+Next to the in-memory copy there is an on-disk binary snapshot: one ``.npy``
+file per column in ``SNAPSHOT_FOLDER``, named after the SHA-1 of the IPAC
+file it was made from.  A process that needs the table maps the snapshot
+with ``np.load(mmap_mode='r')`` instead of parsing the IPAC text, which is
+only parsed (and the snapshot regenerated) when its content has changed.  The
+IPAC file stays the canonical, version-controlled copy of the database.
+
+The table handed out by `get_merged_table` is shared: callers that want to
+modify it must take a ``.copy()`` first.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import numpy as np
+from astropy.io import ascii
+from astropy.table import Table, Column, MaskedColumn
+from astropy import log
+from ingest_datasets_better import set_units, KeyIndex
+from query_engine import RangeIndex
+
+# Column converters used whenever the merged table is read.  Forcing the
+# string widths keeps the columns wide enough to accept new rows.
+merged_table_converters = {'Names': [ascii.convert_numpy('S64')],
+                           'IDs': [ascii.convert_numpy('S64')],
+                           'IsSimulated': [ascii.convert_numpy('S5')],
+                           'IsGalactic': [ascii.convert_numpy('S5')],
+                           'Filename': [ascii.convert_numpy('S36')]}
+
+SNAPSHOT_FOLDER = 'snapshots/'
+
+_store = {}
+_store_lock = threading.Lock()
+
+
+def file_signature(filename):
+    """
+    Return a ``(mtime, size)`` tuple identifying the current version of a file
+    """
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def file_digest(filename, blocksize=2**20):
+    """
+    Return the SHA-1 hex digest of the contents of a file
+    """
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(blocksize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def snapshot_path(filename, digest, snapshot_dir=SNAPSHOT_FOLDER):
+    """
+    Location of the snapshot of ``filename`` with content hash ``digest``
+    """
+    return os.path.join(snapshot_dir,
+                        "{0}.{1}".format(os.path.basename(filename), digest))
+
+
+def write_snapshot(table, filename, digest, snapshot_dir=SNAPSHOT_FOLDER):
+    """
+    Save ``table`` (the parsed contents of ``filename``) as a directory of
+    ``.npy`` column files, and remove older snapshots of the same file.
+    """
+    path = snapshot_path(filename, digest, snapshot_dir=snapshot_dir)
+    if os.path.isdir(path):
+        return path
+
+    if not os.path.isdir(snapshot_dir):
+        os.makedirs(snapshot_dir)
+    # build the snapshot under a temporary name and rename it into place so
+    # that other processes never see a half-written snapshot
+    tmpdir = tempfile.mkdtemp(dir=snapshot_dir, prefix='.tmp_')
+    meta = {'source': os.path.basename(filename), 'sha1': digest,
+            'columns': []}
+    for ii, colname in enumerate(table.colnames):
+        column = table[colname]
+        values = np.asarray(column)
+        if values.dtype.kind == 'O':
+            values = values.astype('U')
+        np.save(os.path.join(tmpdir, '{0}.npy'.format(ii)), values)
+        masked = isinstance(column, MaskedColumn)
+        if masked:
+            np.save(os.path.join(tmpdir, '{0}_mask.npy'.format(ii)),
+                    np.ma.getmaskarray(column))
+        meta['columns'].append({'name': colname,
+                                'unit': (None if column.unit is None
+                                         else column.unit.to_string()),
+                                'masked': masked})
+    with open(os.path.join(tmpdir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    try:
+        os.rename(tmpdir, path)
+    except OSError:
+        # another process wrote the same snapshot first
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    prefix = os.path.basename(filename) + '.'
+    for name in os.listdir(snapshot_dir):
+        old = os.path.join(snapshot_dir, name)
+        if name.startswith(prefix) and old != path:
+            shutil.rmtree(old, ignore_errors=True)
+
+    return path
+
+
+def read_snapshot(path):
+    """
+    Load a snapshot written by `write_snapshot`.  The column data are
+    memory-mapped read-only.
+    """
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+
+    columns = []
+    for ii, colmeta in enumerate(meta['columns']):
+        data = np.load(os.path.join(path, '{0}.npy'.format(ii)),
+                       mmap_mode='r')
+        if colmeta['masked']:
+            mask = np.load(os.path.join(path, '{0}_mask.npy'.format(ii)))
+            column = MaskedColumn(data=data, mask=mask, name=colmeta['name'],
+                                  unit=colmeta['unit'])
+        else:
+            column = Column(data=data, name=colmeta['name'],
+                            unit=colmeta['unit'], copy=False)
+        columns.append(column)
+
+    return Table(columns, copy=False)
+
+
+def parse_merged_table(filename):
+    """
+    Parse the merged IPAC table text, bypassing the cache and any snapshot
+    """
+    table = Table.read(filename, converters=merged_table_converters,
+                       format='ascii.ipac')
+    set_units(table)
+    return table
+
+
+def read_merged_table(filename, snapshot_dir=SNAPSHOT_FOLDER, digest=None):
+    """
+    Read the merged table from its binary snapshot, or parse it and write
+    the snapshot if there is no up-to-date one.  ``digest`` is the SHA-1 of
+    the file, if already known.
+    """
+    if digest is None:
+        digest = file_digest(filename)
+    path = snapshot_path(filename, digest, snapshot_dir=snapshot_dir)
+    if os.path.isdir(path):
+        try:
+            return read_snapshot(path)
+        except (IOError, OSError, ValueError, KeyError) as ex:
+            log.warning("Could not read snapshot {0}: {1}".format(path, ex))
+
+    table = parse_merged_table(filename)
+    try:
+        write_snapshot(table, filename, digest, snapshot_dir=snapshot_dir)
+    except (IOError, OSError) as ex:
+        log.warning("Could not write snapshot of {0}: {1}"
+                    .format(filename, ex))
+    return table
+
+
+def _get_entry(filename):
+    key = os.path.abspath(filename)
+    signature = file_signature(filename)
+
+    with _store_lock:
+        cached = _store.get(key)
+        if cached is None or cached[0] != signature:
+            log.debug("Loading merged table {0} (signature {1})"
+                      .format(filename, signature))
+            digest = file_digest(filename)
+            table = read_merged_table(filename, digest=digest)
+            cached = (signature, table, RangeIndex(table), KeyIndex(table),
+                      digest)
+            _store[key] = cached
+
+    return cached
+
+
+def get_merged_table(filename, return_index=False):
+    """
+    Return the merged table stored in ``filename``, reading it from disk only
+    if it has never been read or has changed since it was last read.
+
+    If ``return_index`` is set, return a ``(table, index)`` tuple where
+    ``index`` is the `~query_engine.RangeIndex` of that same table.
+    """
+    cached = _get_entry(filename)
+    if return_index:
+        return cached[1], cached[2]
+    return cached[1]
+
+
+def get_key_index(filename):
+    """
+    Return the `~ingest_datasets_better.KeyIndex` of the merged table stored
+    in ``filename``
+    """
+    return _get_entry(filename)[3]
+
+
+def get_table_version(filename):
+    """
+    Return the SHA-1 of the contents of the merged table stored in
+    ``filename``, which identifies the version of the database
+    """
+    return _get_entry(filename)[4]
+
+
+def invalidate(filename=None):
+    """
+    Drop the cached copy of ``filename``, or of every table if no filename is
+    given.
+    """
+    with _store_lock:
+        if filename is None:
+            _store.clear()
+        else:
+            _store.pop(os.path.abspath(filename), None)
+
+
+def refresh_merged_table(filename):
+    """
+    Reload ``filename`` after it has been rewritten, regenerating its
+    snapshot and range index
+    """
+    invalidate(filename)
+    return get_merged_table(filename)
@@ -0,0 +1,37 @@
+from column_matcher import ColumnMatcher, column_synonyms
+
+targets = ('IDs', 'SurfaceDensity', 'VelocityDispersion', 'Radius',
+           'IsSimulated', 'IsGalactic', 'Username', 'Filename', 'DataURL',
+           'synthimURL')
+
+
+def test_no_chance_matches():
+    matcher = ColumnMatcher(targets, synonyms=column_synonyms)
+    header = ['name', 'GLON', 'GLAT', 'Flag', 'Dist', 'DeltaV']
+    mapping = matcher.match(header)
+    assert mapping == {'DeltaV': 'VelocityDispersion'}
+    for colname in ['GLAT', 'Flag', 'Dist', 'name']:
+        assert matcher.candidates(colname) == []
+
+
+def test_matches():
+    matcher = ColumnMatcher(targets, synonyms=column_synonyms)
+    header = ['ID', 'Surface_Density', 'vel_dispersion', 'radius_pc',
+              'is_sim', 'Filename']
+    assert matcher.match(header) == {'ID': 'IDs',
+                                     'Surface_Density': 'SurfaceDensity',
+                                     'vel_dispersion': 'VelocityDispersion',
+                                     'radius_pc': 'Radius',
+                                     'is_sim': 'IsSimulated',
+                                     'Filename': 'Filename'}
+
+
+def test_form_majority():
+    forms = [{'size': 'Radius'}, {'size': 'Radius'},
+             {'size': 'SurfaceDensity'}]
+    matcher = ColumnMatcher(targets, forms=forms)
+    assert matcher.match(['size']) == {'size': 'Radius'}
+    matcher.add_form({'size': 'SurfaceDensity'})
+    assert matcher.match(['size']) == {'size': 'Radius'}
+    matcher.add_form({'size': 'SurfaceDensity'})
+    assert matcher.match(['size']) == {'size': 'SurfaceDensity'}
@@ -0,0 +1,29 @@
+import numpy as np
+from astropy import units as u
+from astropy.table import Table, MaskedColumn
+from ingest_datasets_better import append_table
+
+
+def test_append_longer_strings():
+    merged = Table()
+    merged['ADS_ID'] = np.array(['2010', '2011'], dtype='S4')
+    merged['Names'] = MaskedColumn(['ab', 'cd'], mask=[False, True])
+    merged['Radius'] = [1., 2.] * u.pc
+    merged['IDs'] = np.array(['1', '2'], dtype='S1')
+
+    new = Table()
+    new['ADS_ID'] = ['2009ApJ...699.1092R']
+    new['Names'] = ['Rathborne']
+    new['Radius'] = [1000.] * u.mpc
+    new['IDs'] = [12345]
+
+    combined = append_table(merged, new)
+
+    assert combined['ADS_ID'].dtype.kind == 'S'
+    assert combined['ADS_ID'][2] == '2009ApJ...699.1092R'
+    assert combined['ADS_ID'][0] == '2010'
+    assert combined['Names'][2] == 'Rathborne'
+    assert combined['Names'].mask.tolist() == [False, True, False]
+    assert combined['IDs'][2] == '12345'
+    assert combined['Radius'].unit == u.pc
+    np.testing.assert_allclose(combined['Radius'], [1., 2., 1.])
@@ -0,0 +1,40 @@
+import numpy as np
+from astropy import units as u
+from astropy.table import Table
+from simple_plot import plotData
+
+
+def make_table(names):
+    """
+    A small table of the columns plotted by `plotData`, with ``names`` as
+    the Names column
+    """
+    nrows = len(names)
+    table = Table()
+    table['Names'] = names
+    table['IDs'] = np.array(['id{0}'.format(ii) for ii in range(nrows)],
+                            dtype='S8')
+    table['SurfaceDensity'] = np.logspace(1, 3, nrows) * u.M_sun / u.pc**2
+    table['VelocityDispersion'] = np.logspace(0, 1, nrows) * u.km / u.s
+    table['Radius'] = np.logspace(-1, 1, nrows) * u.pc
+    table['IsSimulated'] = np.arange(nrows) % 2 == 0
+    return table
+
+
+def test_plot_bytes_names(tmpdir):
+    # the merged table is cached with bytes (S) string columns
+    names = np.array(['Author A', 'Author B', 'Author A', 'Author C'],
+                     dtype='S64')
+    html_file, png_file = plotData('bytes', make_table(names), 'Test_',
+                                   html_dir=str(tmpdir), png_dir=str(tmpdir),
+                                   xMin=1 * u.M_sun / u.pc**2,
+                                   xMax=1e4 * u.M_sun / u.pc**2,
+                                   yMin=0.1 * u.km / u.s,
+                                   yMax=100 * u.km / u.s,
+                                   zMin=0.01 * u.pc, zMax=100 * u.pc)
+
+    with open(html_file) as f:
+        html = f.read()
+    assert 'Author B' in html
+    assert "b'Author B'" not in html
+    assert open(png_file, 'rb').read(8) == b'\x89PNG\r\n\x1a\n'
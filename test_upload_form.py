@@ -1,11 +1,45 @@
 import os
 import json
+import time
 import ast
 import requests
 from bs4 import BeautifulSoup
 import github_helpers
 
 
+def get_pull_requests(S, response, base_url, testmode, timeout=300):
+    """
+    Find the database and uploads pull requests for a submission.  They are
+    created by the submission worker, so unless the github phase was skipped
+    the submission status is polled until the worker is done.
+    """
+    soup = BeautifulSoup(response.content)
+    if testmode == 'skip':
+        dbpull = [os.path.split(x.attrs['href'])[-1]
+                  for x in soup.find_all('a', href=True)
+                  if 'placeholder' in str(x)][0]
+        return dbpull, dbpull
+
+    status_url = [x.attrs['href'] for x in soup.find_all('a', href=True)
+                  if 'submission_status' in str(x)][0]
+    for ii in range(timeout):
+        r = S.get(base_url + status_url)
+        r.raise_for_status()
+        job = r.json()
+        if job['status'] == 'done':
+            break
+        elif job['status'] == 'failed':
+            raise Exception("Submission failed: {0}".format(job['error']))
+        time.sleep(1)
+    else:
+        raise Exception("Submission did not finish within {0} s"
+                        .format(timeout))
+
+    dbpull = os.path.split(job['result']['link_pull_database'])[-1]
+    uppull = os.path.split(job['result']['link_pull_uploads'])[-1]
+    return dbpull, uppull
+
+
 def test_upload_file(email,
                      filename='benoitcommercon.csv',
                      username='test_BenoitCommerctest_uptestn',
@@ -71,13 +105,7 @@ def test_upload_file(email,
                 data=dictdata)
     r3.raise_for_status()
 
-    soup = BeautifulSoup(r3.content)
-    dbpull = [os.path.split(x.attrs['href'])[-1]
-              for x in soup.find_all('a', href=True)
-              if 'database/pull' in str(x) or 'placeholder' in str(x)][0]
-    uppull = [os.path.split(x.attrs['href'])[-1]
-              for x in soup.find_all('a', href=True)
-              if 'uploads/pull' in str(x) or 'placeholder' in str(x)][0]
+    dbpull, uppull = get_pull_requests(S, r3, base_url, testmode)
 
     if testmode != 'skip':
         db_sc = github_helpers.close_pull_request('database', dbpull)
@@ -172,16 +200,101 @@ def test_upload_rathborne(email,
                 data=dictdata)
     r3.raise_for_status()
 
-    soup = BeautifulSoup(r3.content)
-    dbpull = [os.path.split(x.attrs['href'])[-1]
-              for x in soup.find_all('a', href=True)
-              if 'database/pull' in str(x) or 'placeholder' in str(x)][0]
-    uppull = [os.path.split(x.attrs['href'])[-1]
-              for x in soup.find_all('a', href=True)
-              if 'uploads/pull' in str(x) or 'placeholder' in str(x)][0]
+    dbpull, uppull = get_pull_requests(S, r3, base_url, testmode)
 
     if testmode != 'skip':
         db_sc = github_helpers.close_pull_request('database', dbpull)
         up_sc = github_helpers.close_pull_request('uploads', uppull)
 
     return S, r1, r2, r3
+
+
+def test_api_query(base_url):
+    """
+    Query the database through the JSON API, and check that a narrower query
+    returns a subset of a wider one
+    """
+    S = requests.Session()
+
+    r1 = S.post(base_url + '/api/query',
+                json={'Radius_min': 0.01, 'Radius_max': 1000,
+                      'Radius_unit': 'pc',
+                      'columns': ['Names', 'IDs', 'Radius']})
+    r1.raise_for_status()
+    everything = r1.json()
+    assert everything['nrows'] == len(everything['columns']['IDs'])
+    assert set(everything['columns']) == {'Names', 'IDs', 'Radius'}
+    assert everything['units']['Radius'] == 'pc'
+
+    r2 = S.post(base_url + '/api/query',
+                json={'Radius_min': 0.01, 'Radius_max': 1,
+                      'Radius_unit': 'pc', 'ObsSimBoth': 'IsObserved'})
+    r2.raise_for_status()
+    subset = r2.json()
+    assert subset['nrows'] <= everything['nrows']
+    assert all(radius < 1 for radius in subset['columns']['Radius'])
+    assert not any(is_sim in (True, 'True')
+                   for is_sim in subset['columns']['IsSimulated'])
+
+    r3 = S.get(base_url + '/api/query', params={'format': 'fits'})
+    r3.raise_for_status()
+    assert r3.content.startswith(b'SIMPLE')
+
+    return S, r1, r2, r3
+
+
+def test_partial_query(base_url):
+    """
+    Query the database with limits on the radius only: the other columns are
+    not constrained, and the plots use their default ranges
+    """
+    S = requests.Session()
+
+    r1 = S.post(base_url + '/query/merged_table.ipac',
+                data={'Radius_min': 0.01, 'Radius_max': 1000,
+                      'Radius_unit': 'pc'})
+    r1.raise_for_status()
+    soup = BeautifulSoup(r1.content)
+    assert soup.find('select', attrs={'name': 'format'}) is not None
+
+    r2 = S.post(base_url + '/query/merged_table.ipac?outputs=png',
+                data={'Radius_min': 0.01, 'Radius_unit': 'pc'})
+    r2.raise_for_status()
+    assert r2.content.startswith(b'\x89PNG')
+
+    return S, r1, r2
+
+
+def test_query_download(base_url):
+    """
+    Run a query from the query form, and download its results in every
+    format offered on the result page
+    """
+    S = requests.Session()
+
+    r1 = S.post(base_url + '/query/merged_table.ipac',
+                data={'Radius_min': 0.01, 'Radius_max': 1000,
+                      'Radius_unit': 'pc'})
+    r1.raise_for_status()
+    soup = BeautifulSoup(r1.content)
+    select = soup.find('select', attrs={'name': 'format'})
+    download_url = select.find_parent('form').attrs['action']
+    formats = [option.attrs['value'] for option in select.find_all('option')]
+    assert set(formats) == {'ipac', 'csv', 'ecsv', 'fits'}
+
+    downloads = {}
+    for dataformat in formats:
+        r2 = S.get(base_url + download_url, params={'format': dataformat})
+        r2.raise_for_status()
+        assert 'attachment' in r2.headers['Content-Disposition']
+        downloads[dataformat] = r2.content
+
+    assert downloads['ipac'].startswith(b'|') or b'\n|' in downloads['ipac']
+    assert downloads['ecsv'].startswith(b'# %ECSV')
+    assert downloads['fits'].startswith(b'SIMPLE')
+    assert len(downloads['fits']) % 2880 == 0
+    # one line per row after the column names
+    nrows = len(downloads['csv'].decode('utf-8').splitlines()) - 1
+    assert nrows > 0
+
+    return S, r1, downloads
@@ -0,0 +1,30 @@
+import numpy as np
+import pytest
+from astropy.table import Table
+import upload_reader
+from upload_reader import iter_chunks, read_sample
+
+
+def make_table():
+    table = Table()
+    table['Names'] = ['a', 'b', 'c']
+    table['Radius'] = [1., 2., 3.]
+    return table
+
+
+@pytest.mark.parametrize('cached_size', [upload_reader.CACHED_UPLOAD_SIZE, 0])
+def test_mislabelled_extension(tmpdir, monkeypatch, cached_size):
+    # small uploads are parsed whole and cached, larger ones read in chunks
+    monkeypatch.chdir(tmpdir)
+    monkeypatch.setattr(upload_reader, 'CACHED_UPLOAD_SIZE', cached_size)
+
+    # a VOTable and a CSV file, with the extensions of other formats
+    make_table().write('votable.csv', format='votable')
+    make_table().write('csv.ecsv', format='ascii.csv')
+
+    for filename in ['votable.csv', 'csv.ecsv']:
+        sample = read_sample(filename)
+        assert sample.colnames == ['Names', 'Radius']
+        chunks = list(iter_chunks(filename, chunk_rows=2))
+        assert [len(chunk) for chunk in chunks] == [2, 1]
+        np.testing.assert_allclose(chunks[1]['Radius'], [3.])
@@ -0,0 +1,57 @@
+"""
+Memoized unit parsing and conversion.
+
+The same few unit strings come back all the time: the column form validates
+the unit of a column on every keystroke, and every query and upload parses
+the units of its limits and columns again.  Parsing a unit string with
+astropy and working out a conversion are slow compared to what they are used
+for, so both are cached here, for the lifetime of the process: a conversion
+of values then comes down to multiplying them by a cached scale factor.
+"""
+
+from functools import lru_cache
+from astropy import units as u
+
+UNIT_CACHE_SIZE = 1024
+
+
+@lru_cache(maxsize=UNIT_CACHE_SIZE)
+def parse_unit(unit):
+    """
+    Parse a unit string (or return a unit as it is), like `astropy.units.Unit`
+    """
+    return u.Unit(unit)
+
+
+@lru_cache(maxsize=UNIT_CACHE_SIZE)
+def conversion_factor(from_unit, to_unit):
+    """
+    Scale factor from ``from_unit`` to ``to_unit``, which can be strings or
+    units.  Raises `~astropy.units.UnitConversionError` if they are not
+    equivalent.
+    """
+    return parse_unit(from_unit).to(parse_unit(to_unit))
+
+
+@lru_cache(maxsize=UNIT_CACHE_SIZE)
+def check_unit(unit_str, equivalent_unit=None):
+    """
+    Check a unit string for the column form: 'green' if it is a unit
+    equivalent to ``equivalent_unit`` (or any unit if that is None), 'yellow'
+    if it is a unit but not an equivalent one, and 'red' if it is not a unit.
+    """
+    try:
+        unit = parse_unit(unit_str)
+    except ValueError:
+        return 'red'
+    if equivalent_unit is None:
+        return 'green'
+    try:
+        conversion_factor(unit, equivalent_unit)
+    except u.UnitsError:
+        return 'yellow'
+    except ValueError:
+        # the reference unit itself is not a unit: there is nothing to be
+        # equivalent to
+        return 'red'
+    return 'green'
@@ -0,0 +1,185 @@
+"""
+Vocabulary of unit names for autocompletion.
+
+The names of all the astropy units are collected once (`build_vocabulary`),
+ranked with the units common in CAMELOT first, and saved to
+``UNIT_VOCABULARY_FILE`` together with two indexes:
+
+* ``prefixes``: the lowercase prefixes of up to ``PREFIX_LENGTH`` characters
+  of every name, each with the names that start with it, in rank order
+* ``trigrams``: the lowercase three-letter substrings of every name, each
+  with the names that contain it
+
+`match_units` then answers a search term with a few dictionary lookups.  The
+file is rebuilt when it is missing or was made with another version of
+astropy; ``python all_astropy_units.py`` rebuilds it by hand.
+"""
+
+import os
+import json
+import inspect
+import astropy
+from astropy import units as u
+from astropy import log
+from unit_registry import parse_unit
+from ingest_datasets_better import unit_mapping
+
+UNIT_VOCABULARY_FILE = 'unit_vocabulary.json'
+METADATA_FILE = 'alternate_allowed_metadata.json'
+PREFIX_LENGTH = 3
+MAX_MATCHES = 20
+
+_vocabulary = None
+
+
+def astropy_unit_names():
+    """
+    The names of all the units defined in `astropy.units`
+    """
+    allunits = set()
+    for unitname, unit in inspect.getmembers(u):
+        if isinstance(unit, u.UnitBase):
+            try:
+                for name in unit.names:
+                    allunits.add(name)
+            except AttributeError:
+                continue
+    return allunits
+
+
+def common_unit_names(units):
+    """
+    Names to rank first for a list of common units (strings or units): each
+    unit as given and in astropy's notation, followed by the names of the
+    units it is made of
+    """
+    names = []
+    for unit in units:
+        if unit in (None, 'None', 'none', ''):
+            continue
+        try:
+            parsed = parse_unit(unit)
+        except ValueError:
+            continue
+        if isinstance(unit, str):
+            names.append(unit)
+        names.append(parsed.to_string())
+        names.extend(base.to_string() for base in getattr(parsed, 'bases',
+                                                           []))
+    # remove duplicates, keeping the first occurrence
+    return list(dict.fromkeys(names))
+
+
+def camelot_units(metadata_file=METADATA_FILE):
+    """
+    The units used in CAMELOT: those of the plotted columns and of the
+    additional metadata columns listed in ``metadata_file``
+    """
+    units = ['Msun/pc^2', 'km/s', 'pc'] + list(unit_mapping.values())
+    try:
+        with open(metadata_file) as f:
+            units.extend(v[1] for v in json.load(f).values())
+    except (IOError, ValueError) as ex:
+        log.warning("Could not read {0}: {1}".format(metadata_file, ex))
+    return units
+
+
+def _trigrams(name):
+    name = name.lower()
+    return set(name[i:i + 3] for i in range(len(name) - 2))
+
+
+def build_vocabulary(common_units=None):
+    """
+    Collect and index the unit names, with those of ``common_units`` (by
+    default the `camelot_units`) first and the others from the shortest to
+    the longest
+    """
+    if common_units is None:
+        common_units = camelot_units()
+    common = common_unit_names(common_units)
+    others = sorted(astropy_unit_names().difference(common),
+                    key=lambda name: (len(name), name.lower(), name))
+    names = common + others
+
+    prefixes = {}
+    trigrams = {}
+    for rank, name in enumerate(names):
+        lower = name.lower()
+        for length in range(1, min(len(lower), PREFIX_LENGTH) + 1):
+            prefixes.setdefault(lower[:length], []).append(rank)
+        for trigram in _trigrams(name):
+            trigrams.setdefault(trigram, []).append(rank)
+
+    return {'astropy_version': astropy.__version__,
+            'units': names,
+            'prefixes': prefixes,
+            'trigrams': trigrams}
+
+
+def save_vocabulary(vocabulary, filename=UNIT_VOCABULARY_FILE):
+    with open(filename, 'w') as f:
+        json.dump(vocabulary, f)
+
+
+def load_vocabulary(common_units=None, filename=UNIT_VOCABULARY_FILE):
+    """
+    Load the vocabulary, building and saving it first if needed.  It is kept
+    in memory after the first call.
+    """
+    global _vocabulary
+    if _vocabulary is not None:
+        return _vocabulary
+
+    vocabulary = None
+    if os.path.exists(filename):
+        try:
+            with open(filename) as f:
+                vocabulary = json.load(f)
+        except (IOError, ValueError) as ex:
+            log.warning("Could not read {0}: {1}".format(filename, ex))
+    if (vocabulary is None or
+            vocabulary.get('astropy_version') != astropy.__version__):
+        log.debug("Building the unit vocabulary")
+        vocabulary = build_vocabulary(common_units)
+        try:
+            save_vocabulary(vocabulary, filename)
+        except (IOError, OSError) as ex:
+            log.warning("Could not save {0}: {1}".format(filename, ex))
+
+    _vocabulary = vocabulary
+    return vocabulary
+
+
+def match_units(vocabulary, term, max_matches=MAX_MATCHES):
+    """
+    The best ``max_matches`` unit names for a search term: the names that
+    start with it (with the same case first), then those that contain it,
+    then those that share most of its trigrams, each in rank order
+    """
+    names = vocabulary['units']
+    lower = term.strip().lower()
+    if not lower:
+        return names[:max_matches]
+
+    candidates = vocabulary['prefixes'].get(lower[:PREFIX_LENGTH], [])
+    matches = [rank for rank in candidates
+               if names[rank].lower().startswith(lower)]
+    matches.sort(key=lambda rank: not names[rank].startswith(term.strip()))
+
+    if len(matches) < max_matches:
+        shared = {}
+        for trigram in _trigrams(lower):
+            for rank in vocabulary['trigrams'].get(trigram, []):
+                shared[rank] = shared.get(rank, 0) + 1
+        found = set(matches)
+        contains = [rank for rank in sorted(shared)
+                    if rank not in found and lower in names[rank].lower()]
+        needed = max(1, len(_trigrams(lower)) // 2)
+        similar = sorted((rank for rank, count in shared.items()
+                          if count >= needed and rank not in found and
+                          lower not in names[rank].lower()),
+                         key=lambda rank: (-shared[rank], rank))
+        matches.extend(contains + similar)
+
+    return [names[rank] for rank in matches[:max_matches]]
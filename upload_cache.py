@@ -0,0 +1,115 @@
+"""
+Cache of parsed uploads.
+
+An upload is read once to build the column-mapping page (`uploaded_file`) and
+again when the mapping is submitted (`set_columns`).  The table parsed the
+first time is pickled into ``UPLOAD_CACHE_FOLDER`` under the SHA-1 of the
+file contents and the format it was read with, so the second step loads it
+instead of parsing the file again.  Entries are removed once they are more
+than ``UPLOAD_CACHE_TTL`` seconds old, whenever a new entry is written.
+"""
+
+import os
+import glob
+import time
+import pickle
+import tempfile
+from astropy.table import Table
+from astropy import log
+from table_store import file_digest
+
+UPLOAD_CACHE_FOLDER = 'upload_cache/'
+UPLOAD_CACHE_TTL = 3600
+
+
+def cache_path(digest, fileformat=None, cache_dir=UPLOAD_CACHE_FOLDER):
+    """
+    Location of the cached table for the upload with content hash ``digest``
+    read with ``fileformat``
+    """
+    fileformat = 'auto' if fileformat is None else fileformat
+    return os.path.join(cache_dir, "{0}.{1}.pickle".format(digest,
+                                                            fileformat))
+
+
+def evict_expired(cache_dir=UPLOAD_CACHE_FOLDER, ttl=UPLOAD_CACHE_TTL):
+    """
+    Remove the cache entries that are more than ``ttl`` seconds old
+    """
+    now = time.time()
+    for path in glob.glob(os.path.join(cache_dir, '*.pickle')):
+        try:
+            if now - os.path.getmtime(path) > ttl:
+                os.remove(path)
+        except OSError:
+            # removed by another process in the meantime
+            continue
+
+
+def load_parsed_upload(digest, fileformat=None, cache_dir=UPLOAD_CACHE_FOLDER,
+                       ttl=UPLOAD_CACHE_TTL):
+    """
+    Return the cached table for an upload, or None if it is not cached or
+    has expired
+    """
+    path = cache_path(digest, fileformat, cache_dir=cache_dir)
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError) as ex:
+        if os.path.exists(path):
+            log.warning("Could not read cached upload {0}: {1}"
+                        .format(path, ex))
+        return None
+
+
+def store_parsed_upload(table, digest, fileformat=None,
+                        cache_dir=UPLOAD_CACHE_FOLDER, ttl=UPLOAD_CACHE_TTL):
+    """
+    Cache the parsed table of an upload, and evict expired entries
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    path = cache_path(digest, fileformat, cache_dir=cache_dir)
+    # write under a temporary name and rename into place so that readers
+    # never see a partial pickle
+    fd, tmpname = tempfile.mkstemp(dir=cache_dir, prefix='.tmp_')
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(table, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.rename(tmpname, path)
+    evict_expired(cache_dir, ttl=ttl)
+    return path
+
+
+def discard_parsed_upload(digest, cache_dir=UPLOAD_CACHE_FOLDER):
+    """
+    Remove every cached table of the upload with content hash ``digest``
+    """
+    for path in glob.glob(os.path.join(cache_dir,
+                                       "{0}.*.pickle".format(digest))):
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+
+
+def parse_upload(filename, fileformat=None, digest=None):
+    """
+    Return the parsed table of an uploaded file, from the cache if possible.
+    ``digest`` is the SHA-1 of the file contents, if already known.
+    """
+    if digest is None:
+        digest = file_digest(filename)
+    table = load_parsed_upload(digest, fileformat)
+    if table is None:
+        log.debug("Parsing upload {0} with format {1}"
+                  .format(filename, fileformat))
+        table = Table.read(filename, format=fileformat)
+        try:
+            store_parsed_upload(table, digest, fileformat)
+        except (IOError, OSError, pickle.PicklingError) as ex:
+            log.warning("Could not cache upload {0}: {1}"
+                        .format(filename, ex))
+    return table
@@ -15,31 +15,49 @@ debugging, but try to remove them when you're done.
 
 import re
 import os
-import inspect
 import numpy as np
 import subprocess
 import requests
 import json
+import io
+import gzip
 from ingest_datasets_better import (rename_columns, set_units, convert_units,
                                     add_repeat_column,
                                     add_generic_ids_if_needed,
                                     add_is_sim_if_needed, fix_bad_types,
                                     reorder_columns, append_table,
-                                    ignore_duplicates, update_duplicates,
+                                    update_duplicates, find_duplicate_keys,
+                                    table_keys, KeyIndex,
                                     add_is_gal_if_needed,
-                                    fix_bad_colnames, unit_mapping)
+                                    fix_bad_colnames, fixed_colname,
+                                    unit_mapping)
 from flask import (Flask, request, redirect, url_for, render_template,
-                   send_from_directory, jsonify)
-from simple_plot import plotData, plotData_Sigma_sigma
+                   send_from_directory, jsonify, stream_with_context)
+from simple_plot import plotData, plotData_Sigma_sigma, plot_outputs
 from werkzeug import secure_filename
 import difflib
-import glob
+import functools
 import keyring
 import builtins
 import time
 from datetime import datetime
-from astropy.io import registry, ascii
-from ipac_writer import ipac_writer
+from astropy.io import registry
+from ipac_writer import ipac_writer, ipac_append
+from table_store import (get_merged_table, get_key_index, file_digest,
+                         get_table_version, parse_merged_table,
+                         refresh_merged_table)
+from upload_reader import iter_chunks, read_sample, sniff_format
+from upload_cache import discard_parsed_upload
+from query_engine import parse_query, query_rows, query_table, table_columns
+from render_cache import query_key, touch_artifacts
+from table_download import download_formats, stream_table, gzip_stream
+from submission_queue import (JOB_FOLDER, submit_job, get_job,
+                              register_handler, start_worker)
+from commit_coordinator import submodule_lock, temporary_worktree
+from janitor import record_artifacts, start_janitor, janitor_stats
+from unit_registry import check_unit
+from unit_vocabulary import load_vocabulary, match_units
+from column_matcher import ColumnMatcher, stored_forms, column_synonyms
 from astropy.table import Table
 from astropy.table.jsviewer import write_table_jsviewer
 from astropy import units as u
@@ -47,7 +65,7 @@ from astropy import log
 import jinja2
 if os.getenv('DEBUG'):
     log.setLevel(10)
-import hashlib
+import shutil
 import traceback
 
 UPLOAD_FOLDER = 'uploads/'
@@ -60,21 +78,59 @@ ALLOWED_EXTENSIONS = set(['fits', 'csv', 'txt', 'ipac', 'dat', 'tsv',
 valid_column_names = ['Ignore', 'IDs', 'SurfaceDensity', 'VelocityDispersion',
                       'Radius', 'IsSimulated', 'IsGalactic', 'Username',
                       'Filename', 'DataURL', 'synthimURL']
+# Database columns that upload columns can be matched to
+matched_column_names = tuple(valid_column_names[1:])
 dimensionless_column_names = ['Ignore', 'IDs', 'IsSimulated', 'IsGalactic',
                               'Username', 'Filename', 'Email', 'ObsSim',
                               'GalExgal', "ADS_ID", "Publication_DOI_or_URL", 'doi',
                               'adsid', 'DataURL', 'synthimURL', 'dataurl',
-                              'synthimurl']
+                              'synthimurl', 'DuplicatePolicy']
+duplicate_policies = ['replace', 'ignore', 'reject']
+# Fields of the column form that are not column names
+form_metadata_fields = ['Username', 'Email', 'ObsSim', 'GalExgal', 'adsid',
+                        'doi', 'dataurl', 'synthimurl', 'DuplicatePolicy',
+                        'fileformat']
 use_column_names = ['SurfaceDensity', 'VelocityDispersion', 'Radius']
 use_units = ['Msun/pc^2', 'km/s', 'pc']
 FigureStrBase = 'Output_Sigma_sigma_r_'
 TableStrBase = 'Output_Table_'
-TooOld = 300 # age in seconds of files to delete
+DataStrBase = 'Output_Data_'
+QueryStrBase = 'Output_Query_'
+query_outputs = ['html', 'png', 'json']
+default_query_outputs = ['html', 'png']
+api_formats = ['json', 'fits']
+artifact_budget = 200 * 2**20 # bytes of generated plots and tables to keep
+janitor_interval = 60 # seconds between two checks of the artifact budget
+commit_batch_window = 30 # submissions this close together share one commit
+upload_chunk_rows = 50000 # uploads are ingested this many rows at a time
 git_user = 'SirArthurTheSubmitter'
 submitter_gmail = '{0}@gmail.com'.format(git_user)
 
 table_widths = [64, 64, 20, 20, 20, 12, 12, 26, 36, 20, 64]
 
+# Columns of the merged table, and their types when creating it from scratch
+merged_table_names = ['Names', 'IDs', 'SurfaceDensity', 'VelocityDispersion',
+                      'Radius', 'IsSimulated', 'IsGalactic', 'Timestamp',
+                      'Filename', 'ADS_ID', 'Publication_DOI_or_URL',
+                      'DataURL', 'synthimURL']
+merged_table_dtypes = [('str', 64), ('str', 64), 'float', 'float', 'float',
+                       'bool', 'bool', ('str', 26), ('str', 36), ('str', 20),
+                       ('str', 64), ('str', 64), ('str', 64)]
+
+# Arguments of `plotData_Sigma_sigma` for the limits of each queried column
+plot_limit_names = {'SurfaceDensity': ('SurfMin', 'SurfMax'),
+                    'VelocityDispersion': ('VDispMin', 'VDispMax'),
+                    'Radius': ('RadMin', 'RadMax')}
+
+# Above this many points, plots show the density of the points and only a
+# selection of them individually
+plot_max_points = 5000
+
+# Columns shown in the tooltips of the plotted points
+tooltip_column_names = ['Names', 'IDs', 'SurfaceDensity', 'VelocityDispersion',
+                        'Radius', 'IsSimulated', 'IsGalactic', 'ADS_ID',
+                        'Publication_DOI_or_URL', 'DataURL', 'synthimURL']
+
 table_formats = registry.get_formats(Table)
 
 app = Flask(__name__)
@@ -85,8 +141,13 @@ app.config['PNG_PLOT_FOLDER'] = PNG_PLOT_FOLDER
 app.config['TABLE_FOLDER'] = TABLE_FOLDER
 # app.config['DEBUG']=True
 
+# Folders of the generated files that the janitor cleans up, and the prefixes
+# of the query outputs in them (see `janitor.artifact_group`)
+artifact_folders = (MPLD3_FOLDER, PNG_PLOT_FOLDER, TABLE_FOLDER)
+artifact_prefixes = (FigureStrBase, DataStrBase, QueryStrBase)
+
 # this might be subject to a race condition?  How?!
-for path in (MPLD3_FOLDER, PNG_PLOT_FOLDER, TABLE_FOLDER):
+for path in (MPLD3_FOLDER, PNG_PLOT_FOLDER, TABLE_FOLDER, JOB_FOLDER):
     try:
         log.debug("ls {0}".format(path))
         os.listdir(path)
@@ -189,24 +250,25 @@ def uploaded_file(filename, fileformat=None):
     Handle an uploaded file.  Takes a filename, which points to a file on disk
     in the UPLOAD_FOLDER directory, and an optional file format.
 
+    If no format is given, it is guessed from the start of the file; the
+    guess is passed on to `set_columns` and recorded with the form data.
     If this fails, it will load the ambiguous file format loader
     """
+    full_filename = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    if fileformat is None:
+        fileformat = sniff_format(full_filename)
+        log.debug("Sniffed format {0} for {1}".format(fileformat, filename))
     try:
-        table = Table.read(os.path.join(app.config['UPLOAD_FOLDER'], filename),
-                           format=fileformat)
+        # only the header and the first rows are needed to map the columns
+        table = read_sample(full_filename, fileformat)
     except Exception as ex:
         print("Did not read table with format={0}."
               " Trying to handle ambiguous version.".format(fileformat))
-        return handle_ambiguous_table(filename, ex)
-
-    best_matches = {difflib.get_close_matches(vcn, table.colnames, n=1,
-                                              cutoff=0.4)[0]: vcn
-                    for vcn in valid_column_names
-                    if any(difflib.get_close_matches(vcn, table.colnames, n=1,
-                                                     cutoff=0.4))}
+        return handle_ambiguous_table(filename, ex, fileformat)
 
-    best_column_names = [best_matches[colname] if colname in best_matches
-                         else 'Ignore' for colname in table.colnames]
+    best_column_names = \
+        get_column_matcher(matched_column_names).best_column_names(
+            table.colnames)
 
     # column names can't have non-letters in them or javascript fails
     fix_bad_colnames(table)
@@ -244,17 +306,20 @@ def uploaded_file(filename, fileformat=None):
                            fileformat=fileformat)
 
 
-def handle_ambiguous_table(filename, exception):
+def handle_ambiguous_table(filename, exception, failed_format=None):
     """
     Deal with an uploaded file that doesn't autodetect
     """
-    extension = os.path.splitext(filename)[-1]
-    best_match = difflib.get_close_matches(extension[1:], table_formats, n=1,
-                                           cutoff=0.05)
-    if any(best_match):
-        best_match = best_match[0]
-    else:
-        best_match = ""
+    best_match = sniff_format(os.path.join(app.config['UPLOAD_FOLDER'],
+                                           filename))
+    if best_match is None or best_match == failed_format:
+        extension = os.path.splitext(filename)[-1]
+        best_match = difflib.get_close_matches(extension[1:], table_formats,
+                                               n=1, cutoff=0.05)
+        if any(best_match):
+            best_match = best_match[0]
+        else:
+            best_match = ""
 
     return render_template('upload_form_filetype.html', filename=filename,
                            best_match_extension=best_match,
@@ -264,20 +329,13 @@ def handle_ambiguous_table(filename, exception):
 @app.route('/autocomplete_units', methods=['GET'])
 def autocomplete_units():
     """
-    Autocompletion for units.  NOT USED ANY MORE.
+    Autocompletion for units: the unit names that best match ``term``, with
+    the units used in CAMELOT first (see `unit_vocabulary`)
     """
-    search = request.args.get('term')
-
-    allunits = set()
-    for unitname, unit in inspect.getmembers(u):
-        if isinstance(unit, u.UnitBase):
-            try:
-                for name in unit.names:
-                    allunits.add(name)
-            except AttributeError:
-                continue
+    search = request.args.get('term', '')
+    vocabulary = load_vocabulary()
     app.logger.debug(search)
-    return jsonify(json_list=list(allunits))
+    return jsonify(json_list=match_units(vocabulary, search))
 
 
 @app.route('/unit_map_page')
@@ -289,28 +347,14 @@ def unit_map_page():
 def validate_units():
     """
     Validate the units: try to interpret the passed string as an astropy unit.
+    Answers are memoized, see `unit_registry.check_unit`.
     """
-    print("Unit str: {0} Equiv: {1}".format(request.args.get('unit_str'),
-                                            request.args.get('equivalent_unit')))
-    try:
-        unit_str = request.args.get('unit_str', 'error', type=str)
-        equivalent_unit = request.args.get('equivalent_unit', 'error',
-                                           type=str)
-        if equivalent_unit in ('None', 'none', None):
-            u.Unit(unit_str)
-            OK = 'green'
-        else:
-            try:
-                u.Unit(unit_str).to(u.Unit(equivalent_unit))
-                OK = 'green'
-            except u.UnitsError as ex:
-                print(ex)
-                u.Unit(unit_str)
-                OK = 'yellow'
-    except ValueError as ex:
-        print(ex)
-        OK = 'red'
-    return jsonify(OK=OK)
+    unit_str = request.args.get('unit_str', 'error', type=str)
+    equivalent_unit = request.args.get('equivalent_unit', 'error', type=str)
+    log.debug("Unit str: {0} Equiv: {1}".format(unit_str, equivalent_unit))
+    if equivalent_unit in ('None', 'none'):
+        equivalent_unit = None
+    return jsonify(OK=check_unit(unit_str, equivalent_unit))
 
 
 @app.route('/autocomplete_filetypes', methods=['GET'])
@@ -356,17 +400,6 @@ def set_columns(filename, fileformat=None, testmode=False):
 
     log.debug("Test mode = {0}.".format(testmode))
 
-    log.debug("Reading table {0}".format(filename))
-    try:
-        table = Table.read(os.path.join(app.config['UPLOAD_FOLDER'], filename),
-                           format=fileformat)
-    except Exception as ex:
-        return render_template('error.html', error=str(ex),
-                               traceback=traceback.format_exc(ex))
-
-    # Have to fix the column reading twice
-    fix_bad_colnames(table)
-
     log.debug("Parsing column data.")
     log.debug("form: {0}".format(request.form))
     column_data = {field: {'Name': value}
@@ -388,34 +421,189 @@ def set_columns(filename, fileformat=None, testmode=False):
     log.debug("Created mapping.")
     mapping = {filename: [column_data, units_data]}  # Not used??
 
-    log.debug("Further table handling.")
+    duplicate_policy = request.form.get('DuplicatePolicy', 'replace')
+    if duplicate_policy not in duplicate_policies:
+        raise InvalidUsage("Unknown duplicate policy {0}; it must be one of "
+                           "{1}".format(duplicate_policy,
+                                        ", ".join(duplicate_policies)))
+
+    merged_table_name = os.path.join(app.config['DATABASE_FOLDER'],
+                                     'merged_table.ipac')
+    if duplicate_policy == 'reject' and os.path.isfile(merged_table_name):
+        # Check against the served database now rather than letting the
+        # submission fail in the background
+        key_index = get_key_index(merged_table_name)
+    else:
+        key_index = None
+
+    # The uploaded file will be renamed to something unique, and this name
+    # stored in the table
+    extension = os.path.splitext(filename)[-1]
+    full_filename_old = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+    digest = file_digest(full_filename_old)
+    unique_filename = digest[0:36 - len(extension)] + extension
+    timestamp = datetime.now()
+
+    # Parse the table file, step-by-step, one chunk of rows at a time; each
+    # ingested chunk is staged for the submission worker straight away.  Only
+    # the columns mapped in the form are read.
+    log.debug("Reading table {0}".format(filename))
+    staged_table_names = []
+    keys = []
+    nrows = 0
+    table = None
+    try:
+        include_names = ingested_column_names(
+            read_sample(full_filename_old, fileformat, nrows=1,
+                        digest=digest).colnames,
+            column_data)
+        log.debug("Reading columns {0}".format(include_names))
+        for chunk in iter_chunks(full_filename_old, fileformat,
+                                 chunk_rows=upload_chunk_rows,
+                                 digest=digest,
+                                 include_names=include_names):
+            chunk = ingest_chunk(chunk, column_data, units_data, request.form,
+                                 timestamp, unique_filename, first_id=nrows)
+            nrows += len(chunk)
+            keys.append(table_keys(chunk))
+            if key_index is not None:
+                check_duplicates(chunk, key_index, duplicate_policy)
+
+            staged_table_name = \
+                os.path.join(JOB_FOLDER, "{0}_staged_{1}.ecsv"
+                             .format(os.path.splitext(unique_filename)[0],
+                                     len(staged_table_names)))
+            stage_table(chunk, staged_table_name)
+            staged_table_names.append(staged_table_name)
+            # the first chunk is what gets plotted and shown
+            if table is None:
+                table = chunk
+
+        # Detect duplicate IDs in uploaded data and bail out if found
+        duplicate_keys = find_duplicate_keys(np.concatenate(keys)
+                                             if keys else [])
+        if len(duplicate_keys) > 0:
+            raise InvalidUsage("Duplicate ID detected in table: username = "
+                               "{0}, id = {1}. All IDs must be unique."
+                               .format(*duplicate_keys[0].split('\t')))
+        if table is None:
+            raise InvalidUsage("No entries found in {0}".format(filename))
+    except Exception as ex:
+        for staged_table_name in staged_table_names:
+            os.remove(staged_table_name)
+        if testmode or isinstance(ex, InvalidUsage):
+            raise
+        return render_template('error.html', error=str(ex),
+                               traceback=traceback.format_exc())
+
+    full_filename_new = os.path.join(app.config['UPLOAD_FOLDER'],
+                                     unique_filename)
+    os.rename(full_filename_old, full_filename_new)
+    discard_parsed_upload(digest)
+
+    store_form_data(request, fileformat, unique_filename)
+
+    username = column_data.get('Username')['Name']
+
+    # Merging into the database, committing, opening the pull requests and
+    # registering the e-mail address all happen in the submission worker
+    job_id = submit_job('submission',
+                        {'username': username,
+                         'email': request.form['Email'],
+                         'unique_filename': unique_filename,
+                         'staged_table_names': staged_table_names,
+                         'duplicate_policy': duplicate_policy,
+                         'testmode': testmode})
+
+    if nrows > len(table):
+        errormessage = ("Showing the first {0} of the {1} submitted entries."
+                        .format(len(table), nrows))
+    else:
+        errormessage = None
+
+    if testmode == 'skip':
+        link_pull_database, link_pull_uploads = 'placeholder', 'placeholder'
+    else:
+        link_pull_database, link_pull_uploads = None, None
+
+    outfilename = os.path.splitext(filename)[0]
+    log.debug("Creating plot {0}.".format(outfilename))
+    myplot_html, myplot_png = \
+        plotData_Sigma_sigma(timeString(), table, outfilename,
+                             html_dir=app.config['MPLD3_FOLDER'],
+                             png_dir=app.config['PNG_PLOT_FOLDER'],
+                             tooltip_columns=tooltip_column_names,
+                             max_points=plot_max_points)
+
+    log.debug("Creating table.")
+    tablecss = "table,th,td,tr,tbody {border: 1px solid black; border-collapse: collapse;}"
+    table_name = os.path.join(TABLE_FOLDER, '{fn}.html'.format(fn=outfilename))
+    write_table_jsviewer(table,
+                         table_name,
+                         css=tablecss,
+                         jskwargs={'use_local_files': False},
+                         table_id=outfilename)
+    record_outputs([table_name] +
+                   [plot for plot in (myplot_html, myplot_png) if plot])
+
+    if myplot_html is None:
+        assert myplot_png is None  # should be both or neither
+        imagename = None
+        png_imagename = None
+    else:
+        imagename = '/' + myplot_html
+        png_imagename = "/" + myplot_png
+
+    return render_template('show_plot.html',
+                           imagename=imagename,
+                           png_imagename=png_imagename,
+                           tablefile='{fn}.html'.format(fn=outfilename),
+                           job_id=job_id,
+                           errormessage=errormessage,
+                           link_pull_uploads=link_pull_uploads,
+                           link_pull_database=link_pull_database)
+
+
+def ingested_column_names(colnames, column_data):
+    """
+    The columns of an upload that the column form maps to a column of the
+    database, i.e. those that need to be read at all.  ``colnames`` are the
+    names in the file, before `fix_bad_colnames`.
+    """
+    return [colname for colname in colnames
+            if fixed_colname(colname) in column_data and
+            column_data[fixed_colname(colname)]['Name'] != 'Ignore']
+
+
+def ingest_chunk(table, column_data, units_data, form, timestamp,
+                 unique_filename, first_id=0):
+    """
+    Run the ingestion pipeline on one chunk of an uploaded table: rename the
+    columns according to the column form, set and convert their units, and
+    add the columns derived from the rest of the form.  Generated IDs start
+    at ``first_id``.  Returns the chunk with the columns of the merged table.
+    """
+    fix_bad_colnames(table)
+
     key_rename_mapping = {k: v['Name'] for k, v in list(column_data.items())}
     log.debug("Mapping: {0}".format(key_rename_mapping))
-    # Parse the table file, step-by-step
     rename_columns(table, key_rename_mapping)
     set_units(table, units_data)
     table = fix_bad_types(table)
-    try:
-        convert_units(table)
-    except Exception as ex:
-        if testmode:
-            raise ex
-        else:
-            return render_template('error.html', error=str(ex),
-                                   traceback=traceback.format_exc(ex))
+    convert_units(table)
+
     add_repeat_column(table, column_data.get('Username')['Name'], 'Names')
     if 'ADS_ID' not in table.colnames:
-        add_repeat_column(table, request.form['adsid'], 'ADS_ID')
+        add_repeat_column(table, form['adsid'], 'ADS_ID')
     if 'Publication_DOI_or_URL' not in table.colnames:
-        add_repeat_column(table, request.form['doi'], 'Publication_DOI_or_URL')
+        add_repeat_column(table, form['doi'], 'Publication_DOI_or_URL')
     if 'DataURL' not in table.colnames:
-        add_repeat_column(table, request.form['dataurl'], 'DataURL')
+        add_repeat_column(table, form['dataurl'], 'DataURL')
     if 'synthimURL' not in table.colnames:
-        add_repeat_column(table, request.form['synthimurl'], 'synthimURL')
-    timestamp = datetime.now()
+        add_repeat_column(table, form['synthimurl'], 'synthimURL')
     add_repeat_column(table, timestamp, 'Timestamp')
 
-    add_generic_ids_if_needed(table)
+    add_generic_ids_if_needed(table, start=first_id)
     if column_data.get('ObsSim')['Name'] == 'IsObserved':
         add_is_sim_if_needed(table, False)
     else:
@@ -426,54 +614,32 @@ def set_columns(filename, fileformat=None, testmode=False):
     else:
         add_is_gal_if_needed(table, True)
 
-    # Rename the uploaded file to something unique, and store this name
-    # in the table
-    extension = os.path.splitext(filename)[-1]
-    full_filename_old = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    with open(full_filename_old) as file:
-        unique_filename = \
-            hashlib.sha1(file.read()).hexdigest()[0:36 - len(extension)] + \
-            extension
-    full_filename_new = os.path.join(app.config['UPLOAD_FOLDER'],
-                                     unique_filename)
-    os.rename(full_filename_old, full_filename_new)
     add_repeat_column(table, unique_filename, 'Filename')
-    log.debug("Table column names after add_filename_column: ", table.colnames)
 
-    store_form_data(request, fileformat, unique_filename)
+    return reorder_columns(table, merged_table_names)
 
-    handle_email(request.form['Email'], unique_filename)
-
-    # Detect duplicate IDs in uploaded data and bail out if found
-    seen = {}
-    for row in table:
-        name = row['Names']
-        id = row['IDs']
-        if id in seen:
-            raise InvalidUsage("Duplicate ID detected in table: username = {0}"
-                               ", id = {1}. All IDs must be"
-                               " unique.".format(name, id))
-        else:
-            seen[id] = name
 
-    # If merged table already exists, then append the new entries.
-    # Otherwise, create the table
+def stage_table(table, staged_table_name):
+    """
+    Save an ingested upload for the submission worker.  Object columns (the
+    timestamp) are stored as strings, which is how they end up in the IPAC
+    table anyway.
+    """
+    table = table.copy()
+    for colname in table.colnames:
+        if table[colname].dtype.kind == 'O':
+            table[colname] = table[colname].astype('str')
+    table.write(staged_table_name, format='ascii.ecsv', overwrite=True)
+
 
-    merged_table_name = os.path.join(app.config['DATABASE_FOLDER'],
-                                     'merged_table.ipac')
+def prepare_merged_table(merged_table_name):
+    """
+    Return a modifiable copy of the merged table, filling in any columns that
+    older versions of the database did not have, or a new empty table if there
+    is no database yet.
+    """
     if os.path.isfile(merged_table_name):
-        merged_table = Table.read(merged_table_name,
-                                  converters={'Names':
-                                              [ascii.convert_numpy('S64')],
-                                              'IDs':
-                                              [ascii.convert_numpy('S64')],
-                                              'IsSimulated':
-                                              [ascii.convert_numpy('S5')],
-                                              'IsGalactic':
-                                              [ascii.convert_numpy('S5')],
-                                              'Filename':
-                                              [ascii.convert_numpy('S36')]},
-                                  format='ascii.ipac')
+        merged_table = parse_merged_table(merged_table_name)
         if 'IsGalactic' not in merged_table.colnames:
             # Assume that anything we didn't already tag as Galactic is
             # probably Galactic
@@ -513,14 +679,8 @@ def set_columns(filename, fileformat=None, testmode=False):
         # TODO: Adjust these numbers to something more reasonable, once we
         #       figure out what that is, and verify that submitted data obeys
         #       these limits
-        names = ['Names', 'IDs', 'SurfaceDensity',
-                 'VelocityDispersion', 'Radius', 'IsSimulated', 'IsGalactic',
-                 'Timestamp', 'Filename', 'ADS_ID', 'Publication_DOI_or_URL',
-                 'DataURL', 'synthimURL']
-        col_dtypes = [('str', 64), ('str', 64), 'float', 'float', 'float',
-                      'bool', 'bool', ('str', 26), ('str', 36), ('str', 20),
-                      ('str', 64), ('str', 64), ('str', 64)]
-        merged_table = Table(data=None, names=names, dtype=col_dtypes)
+        merged_table = Table(data=None, names=merged_table_names,
+                             dtype=merged_table_dtypes)
         # dts = merged_table.dtype
         # Hack to force fixed-width: works only on strings
         # merged_table.add_row(["_"*dts[ind].itemsize if dts[ind].kind=='S'
@@ -529,120 +689,250 @@ def set_columns(filename, fileformat=None, testmode=False):
         #                       for ind in range(len(dts))])
         set_units(merged_table)
 
+    return merged_table
+
+
+def merge_upload(merged_table, table, duplicate_policy='replace'):
+    """
+    Append an ingested upload to the merged table.  Returns the new merged
+    table, and whether rows that were already in the merged table had to be
+    removed or replaced.
+    """
     table = reorder_columns(table, merged_table.colnames)
     print("Table column names after reorder_columns: ", table.colnames)
     print("Merged table column names after reorder_columns: ",
           merged_table.colnames)
 
-    # Detect whether any username, ID pairs match entries already in the
-    # merged table
-    duplicates = {}
-    for row in merged_table:
-        name = row['Names']
-        id = row['IDs']
-        if id in seen:
-            if name == seen[id]:
-                duplicates[id] = name
+    replaced = handle_duplicates(table, merged_table, duplicate_policy)
 
-    handle_duplicates(table, merged_table, duplicates)
+    merged_table = append_table(merged_table, table)
 
-    append_table(merged_table, table)
+    return merged_table, replaced
 
-    username = column_data.get('Username')['Name']
 
-    if testmode != 'skip':
-        try:
+def batch_username(usernames):
+    """
+    Name used for the branch and pull request of a batch of submissions
+    """
+    unique_usernames = sorted(set(usernames), key=usernames.index)
+    if len(unique_usernames) == 1:
+        return unique_usernames[0]
+    return '{0}_and_{1}_others'.format(unique_usernames[0],
+                                       len(unique_usernames) - 1)
+
+
+def commit_submissions(payloads, testmode=False):
+    """
+    Merge a batch of staged uploads into the database, commit them and the
+    raw uploads on one branch per submodule, and open the pull requests.
+    """
+    username = batch_username([payload['username'] for payload in payloads])
+    rejected = {}
+
+    with submodule_lock('database'), submodule_lock('uploads'):
+        with temporary_worktree(app.config['DATABASE_FOLDER']) as \
+                database_dir, \
+                temporary_worktree(app.config['UPLOAD_FOLDER']) as \
+                uploads_dir:
+            merged_table_name = os.path.join(database_dir, 'merged_table.ipac')
+            merged_table = prepare_merged_table(merged_table_name)
+            # unless existing rows change, only the new rows need writing
+            append_from = len(merged_table)
+
+            uploads = []
+            for payload in payloads:
+                merged_before = merged_table
+                try:
+                    for staged_table_name in payload['staged_table_names']:
+                        table = Table.read(staged_table_name,
+                                           format='ascii.ecsv')
+                        merged_table, replaced = \
+                            merge_upload(merged_table, table,
+                                         payload.get('duplicate_policy',
+                                                     'replace'))
+                        if replaced:
+                            append_from = None
+                except InvalidUsage as ex:
+                    # the upload clashes with an entry that was added since
+                    # it was submitted: leave it out of the batch.  Only the
+                    # 'reject' policy raises, and it never modifies the
+                    # merged table, so the earlier chunks are simply dropped.
+                    rejected[payload['unique_filename']] = ex.message
+                    merged_table = merged_before
+                    continue
+
+                unique_filename = payload['unique_filename']
+                for upload in (unique_filename,
+                               os.path.splitext(unique_filename)[0] +
+                               "_formdata.json"):
+                    shutil.copy(os.path.join(app.config['UPLOAD_FOLDER'],
+                                             upload),
+                                os.path.join(uploads_dir, upload))
+                    uploads.append(upload)
+
+            if not uploads:
+                return None, None, rejected
+
             link_pull_database, link_pull_uploads = \
                 create_pull_request(username=username,
                                     merged_table=merged_table,
                                     merged_table_name=merged_table_name,
                                     table_widths=table_widths,
-                                    unique_filename=unique_filename,
-                                    testmode=testmode)
+                                    uploads=uploads,
+                                    append_from=append_from,
+                                    testmode=testmode,
+                                    database_dir=database_dir,
+                                    uploads_dir=uploads_dir)
+
+    if isinstance(link_pull_database, Exception):
+        raise link_pull_database
+
+    return link_pull_database, link_pull_uploads, rejected
+
+
+def process_submissions(job_ids, payloads):
+    """
+    Submission worker job: all submissions queued within
+    ``commit_batch_window`` seconds of each other are committed together.
+    Test submissions are kept apart from real ones, and those with
+    ``testmode='skip'`` are not committed at all.  If committing one of these
+    groups fails, only the jobs of that group fail.  The e-mail addresses are
+    registered once the commits are done, and a failure to do so is only
+    logged.
+    """
+    links = {}
+    rejected = {}
+    failed = {}
+    for testmode in (False, True, 'skip'):
+        batch = [payload for payload in payloads
+                 if payload['testmode'] == testmode]
+        if not batch:
+            continue
+        if testmode == 'skip':
+            links[testmode] = ('placeholder', 'placeholder')
+            continue
+        try:
+            link_pull_database, link_pull_uploads, batch_rejected = \
+                commit_submissions(batch, testmode=testmode)
         except Exception as ex:
-            if testmode:
-                raise ex
-            else:
-                return render_template('error.html', error=str(ex),
-                                       traceback=traceback.format_exc(ex))
-        if isinstance(link_pull_database, Exception):
-            ex = link_pull_database
-            return render_template('error.html', error=str(ex),
-                                   traceback=traceback.format_exc(ex))
-    else:
-        link_pull_database, link_pull_uploads = 'placeholder', 'placeholder'
+            log.warning("Committing the submissions with testmode={0} "
+                        "failed: {1}".format(testmode, ex))
+            failed[testmode] = ex
+            continue
+        links[testmode] = (link_pull_database, link_pull_uploads)
+        rejected.update(batch_rejected)
 
-    outfilename = os.path.splitext(filename)[0]
-    log.debug("Creating plot {0}.".format(outfilename))
-    myplot_html, myplot_png = \
-        plotData_Sigma_sigma(timeString(), table, outfilename,
-                             html_dir=app.config['MPLD3_FOLDER'],
-                             png_dir=app.config['PNG_PLOT_FOLDER'])
+    for payload in payloads:
+        for staged_table_name in payload['staged_table_names']:
+            try:
+                os.remove(staged_table_name)
+            except OSError:
+                continue
 
-    log.debug("Creating table.")
-    tablecss = "table,th,td,tr,tbody {border: 1px solid black; border-collapse: collapse;}"
-    table_name = os.path.join(TABLE_FOLDER, '{fn}.html'.format(fn=outfilename))
-    write_table_jsviewer(table,
-                         table_name,
-                         css=tablecss,
-                         jskwargs={'use_local_files': False},
-                         table_id=outfilename)
+    for payload in payloads:
+        if (payload['testmode'] in failed or
+                payload['unique_filename'] in rejected):
+            continue
+        try:
+            handle_email(payload['email'], payload['unique_filename'])
+        except Exception as ex:
+            log.warning("Could not register the e-mail address of the "
+                        "submitter of {0}: {1}"
+                        .format(payload['unique_filename'], ex))
+
+    results = []
+    for payload in payloads:
+        if payload['testmode'] in failed:
+            # marks this job as failed, see `submission_queue.run_next_job`
+            results.append(failed[payload['testmode']])
+        elif payload['unique_filename'] in rejected:
+            results.append({'link_pull_database': None,
+                            'link_pull_uploads': None,
+                            'rejected': rejected[payload['unique_filename']]})
+        else:
+            results.append({'link_pull_database':
+                            links[payload['testmode']][0],
+                            'link_pull_uploads':
+                            links[payload['testmode']][1]})
+    return results
 
-    if myplot_html is None:
-        assert myplot_png is None  # should be both or neither
-        imagename = None
-        png_imagename = None
-    else:
-        imagename = '/' + myplot_html
-        png_imagename = "/" + myplot_png
 
-    return render_template('show_plot.html',
-                           imagename=imagename,
-                           png_imagename=png_imagename,
-                           tablefile='{fn}.html'.format(fn=outfilename),
-                           link_pull_uploads=link_pull_uploads,
-                           link_pull_database=link_pull_database)
+register_handler('submission', process_submissions,
+                 batch_window=commit_batch_window)
+
+
+@app.route('/submission_status/<job_id>')
+def submission_status(job_id):
+    """
+    Report the progress of a queued submission as JSON
+    """
+    job = get_job(job_id)
+    if job is None:
+        raise InvalidUsage("No submission with ID {0}".format(job_id),
+                           status_code=404)
+    return jsonify(job)
 
 
 def create_pull_request(username, merged_table, merged_table_name,
-                        table_widths, unique_filename, testmode=False):
+                        table_widths, uploads, append_from=None,
+                        testmode=False, database_dir='database/',
+                        uploads_dir='uploads/'):
+    """
+    Commit the merged table and the raw uploads on new branches and open the
+    pull requests.
+
+    If ``append_from`` is given, the rows of ``merged_table`` before that
+    index are assumed to be unchanged from the file on disk, and only the
+    rows after it are appended to the file.
+    """
     # go to appropriate branches in the database gits
     print("Re-fetching the databases.")
     check_authenticate_with_github()
     branch_database, timestamp = setup_submodule(username,
-                                                 workingdir='database/',
+                                                 workingdir=database_dir,
                                                  database='database',
                                                  testmode=testmode)
     branch_uploads, timestamp = setup_submodule(username,
-                                                workingdir='uploads/',
+                                                workingdir=uploads_dir,
                                                 database='uploads',
                                                 timestamp=timestamp,
                                                 branch=branch_database)
 
-    # write the modified table
-    ipac_writer(merged_table, merged_table_name, widths=table_widths)
+    # write the modified table: append the new rows if possible, otherwise
+    # rewrite it in full
+    if (append_from is None or
+        not ipac_append(merged_table[append_from:], merged_table_name,
+                        widths=table_widths)):
+        ipac_writer(merged_table, merged_table_name, widths=table_widths)
 
     print("Committing changes")
     # Add merged data to database
     branch_database, timestamp = \
         commit_change_to_database(username,
+                                  workingdir=database_dir,
                                   branch=branch_database,
                                   timestamp=timestamp)
 
-    uploads = [unique_filename,
-               os.path.splitext(unique_filename)[0] + "_formdata.json"]
     try:
         # Adding raw file to uploads
         branch_uploads, timestamp = \
             commit_change_to_database(username, tablename=uploads,
-                                      workingdir='uploads/',
+                                      workingdir=uploads_dir,
                                       database='uploads',
                                       branch=branch_database,
                                       timestamp=timestamp)
     except Exception as ex:
-        cleanup_git_directory('uploads/', allow_fail=False)
+        cleanup_git_directory(uploads_dir, allow_fail=False)
         return ex, ex
 
+    if is_local_remote(remote_url('origin', database_dir)):
+        # There is no github to open pull requests on: point to the pushed
+        # branches instead
+        return ('{0} {1}'.format(remote_url('origin', database_dir).strip(),
+                                 branch_database),
+                '{0} {1}'.format(remote_url('origin', uploads_dir).strip(),
+                                 branch_database))
+
     try:
         log.debug("Creating pull requests")
         response_database, link_pull_database = pull_request(branch_database,
@@ -655,13 +945,31 @@ def create_pull_request(username, merged_table, merged_table_name,
                                                            database='uploads',
                                                            testmode=testmode)
     except Exception as ex:
-        cleanup_git_directory('uploads/', allow_fail=False)
-        cleanup_git_directory('database/', allow_fail=False)
+        cleanup_git_directory(uploads_dir, allow_fail=False)
+        cleanup_git_directory(database_dir, allow_fail=False)
         return ex, ex
 
     return link_pull_database, link_pull_uploads
 
 
+def remote_url(remote, workingdir):
+    """
+    Return the URL of a git remote (including the trailing newline)
+    """
+    return subprocess.check_output(['git', 'config', '--get',
+                                    'remote.{remote}.url'.format(remote=remote)],
+                                   cwd=workingdir, universal_newlines=True)
+
+
+def is_local_remote(url):
+    """
+    Check whether a git remote URL points to a repository on the local
+    filesystem, e.g. a bare repository standing in for github.  The github API
+    steps are skipped for such remotes.
+    """
+    return not re.match(r'^([a-z+]+://|[^/]+@[^/]+:)', url.strip())
+
+
 def setup_submodule(username, remote='origin', workingdir='database/',
                     database='database', branch=None, timestamp=None,
                     testmode=False):
@@ -677,10 +985,7 @@ def setup_submodule(username, remote='origin', workingdir='database/',
             branch = '{0}_{1}'.format(username, timestamp)
         log.debug("Branch name: {0}".format(branch))
 
-    check_upstream = \
-        subprocess.check_output(['git', 'config', '--get',
-                                 'remote.{remote}.url'.format(remote=remote)],
-                                cwd=workingdir)
+    check_upstream = remote_url(remote, workingdir)
     name = os.path.split(check_upstream)[1][:-5]
     if name != database:
         raise Exception("Error: the remote URL {0} "
@@ -731,10 +1036,7 @@ def commit_change_to_database(username, remote='origin',
         re.compile('[A-Za-z0-9]_')
         branch = '{0}_{1}'.format(re.sub("", username), timestamp)
 
-    check_upstream = \
-        subprocess.check_output(['git', 'config', '--get',
-                                 'remote.{remote}.url'.format(remote=remote)],
-                                cwd=workingdir)
+    check_upstream = remote_url(remote, workingdir)
     name = os.path.split(check_upstream)[1][:-5]
     if name != database:
         raise Exception("Error: the remote URL {0} (which is really '{2}') "
@@ -753,7 +1055,8 @@ def commit_change_to_database(username, remote='origin',
     print("Staged diff")
     # diff checking with --cached includes staged files
     diff_result = subprocess.check_output(['git', 'diff', '--cached'],
-                                          cwd=workingdir)
+                                          cwd=workingdir,
+                                          universal_newlines=True)
     # if there is no difference, it is not possible to commit
     if diff_result == '':
         checkout_master(remote, workingdir)
@@ -777,16 +1080,17 @@ def commit_change_to_database(username, remote='origin',
                         .format(workingdir))
 
     # Check that pushing succeeded
-    api_url_branch = \
-        'https://api.github.com/repos/camelot-project/{0}/branches/{1}'.format(database, branch)
+    if not is_local_remote(check_upstream):
+        api_url_branch = \
+            'https://api.github.com/repos/camelot-project/{0}/branches/{1}'.format(database, branch)
 
-    for ii in range(retry):
-        branch_exists = requests.get(api_url_branch)
-        if branch_exists.ok:
-            break
-        else:
-            time.sleep(0.1)
-    branch_exists.raise_for_status()
+        for ii in range(retry):
+            branch_exists = requests.get(api_url_branch)
+            if branch_exists.ok:
+                break
+            else:
+                time.sleep(0.1)
+        branch_exists.raise_for_status()
 
     checkout_master(remote, workingdir)
 
@@ -861,15 +1165,54 @@ def pull_request(branch, user, timestamp, database='database', retry=5,
     return response, pull_url
 
 
-def handle_duplicates(table, merged_table, duplicates):
-    print("TODO: DO SOMETHING HERE (handle duplicates)")
+def check_duplicates(table, key_index, duplicate_policy):
+    """
+    Find the rows of ``table`` whose (Names, IDs) pair is already in the
+    database described by ``key_index``.  Raises `InvalidUsage` if there are
+    any and the policy is to reject them.
+    """
+    duplicates = key_index.contains(table_keys(table))
+    if duplicate_policy == 'reject' and np.any(duplicates):
+        duplicate_ids = table['IDs'][duplicates]
+        raise InvalidUsage("{0} entries of this table are already in the "
+                           "database (username = {1}, IDs = {2}).  Choose "
+                           "to replace or ignore them, or change their IDs."
+                           .format(len(duplicate_ids), table['Names'][0],
+                                   ", ".join(str(x)
+                                             for x in duplicate_ids[:10])))
+    return duplicates
+
+
+def handle_duplicates(table, merged_table, duplicate_policy='replace'):
+    """
+    Apply the duplicate policy to entries of ``table`` whose (Names, IDs)
+    pair is already in ``merged_table``:
+
+    * 'reject': raise `InvalidUsage`
+    * 'ignore': drop them from ``table``, keeping the existing entries
+    * 'replace': drop the existing entries from ``merged_table``
+
+    Both tables are modified in place.  Returns True if rows of the merged
+    table were removed.
+    """
+    duplicates = check_duplicates(table, KeyIndex(merged_table),
+                                  duplicate_policy)
+    if not np.any(duplicates):
+        return False
+
+    if duplicate_policy == 'ignore':
+        table.remove_rows(np.flatnonzero(duplicates))
+        return False
+    else:
+        update_duplicates(merged_table, table_keys(table)[duplicates])
+        return True
 
 
 @app.route('/query_form')
 def query_form(filename="merged_table.ipac"):
 
-    table = Table.read(os.path.join(app.config['DATABASE_FOLDER'],
-                       filename), format='ascii.ipac')
+    table = get_merged_table(os.path.join(app.config['DATABASE_FOLDER'],
+                                          filename))
 
     tolerance = 1.2
 
@@ -889,14 +1232,9 @@ def query_form(filename="merged_table.ipac"):
 
     usetable = table[use_column_names]
 
-    best_matches = {difflib.get_close_matches(vcn, usetable.colnames, n=1,
-                                              cutoff=0.4)[0]: vcn
-                    for vcn in use_column_names
-                    if any(difflib.get_close_matches(vcn, usetable.colnames,
-                                                     n=1, cutoff=0.4))}
-
-    best_column_names = [best_matches[colname] if colname in best_matches
-                         else 'Ignore' for colname in usetable.colnames]
+    best_column_names = \
+        get_column_matcher(tuple(use_column_names)).best_column_names(
+            usetable.colnames)
 
     return render_template("query_form.html", table=table, usetable=usetable,
                            use_units=use_units, filename=filename,
@@ -906,24 +1244,24 @@ def query_form(filename="merged_table.ipac"):
                            max_values=max_values)
 
 
-def clearOutput():
-    for fl in glob.glob(os.path.join(app.config['MPLD3_FOLDER'],
-                        FigureStrBase + "*.png")):
-        now = time.time()
-        if os.stat(fl).st_mtime < now - TooOld:
-            os.remove(fl)
+@functools.lru_cache(maxsize=None)
+def get_column_matcher(targets):
+    """
+    The `ColumnMatcher` of column names to ``targets`` (a tuple), with the
+    built-in synonyms and those of the earlier uploads.  It is made once per
+    tuple of targets and memoizes its matches.
+    """
+    return ColumnMatcher(targets, synonyms=column_synonyms,
+                         forms=stored_forms(app.config['UPLOAD_FOLDER']),
+                         ignore_fields=form_metadata_fields)
 
-    for fl in glob.glob(os.path.join(app.config['TABLE_FOLDER'],
-                                     TableStrBase + "*.ipac")):
-        now = time.time()
-        if os.stat(fl).st_mtime < now - TooOld:
-            os.remove(fl)
 
-    for fl in glob.glob(os.path.join(app.config['MPLD3_FOLDER'],
-                                     FigureStrBase + "*.html")):
-        now = time.time()
-        if os.stat(fl).st_mtime < now - TooOld:
-            os.remove(fl)
+def record_outputs(paths):
+    """
+    Record generated files as just made or used, for the janitor to evict the
+    least recently used ones
+    """
+    record_artifacts(paths, prefixes=artifact_prefixes)
 
 
 def timeString():
@@ -931,93 +1269,295 @@ def timeString():
     return TimeString
 
 
+def query_output_paths(NQuery):
+    """
+    Files of the outputs of the query with key ``NQuery``, by output kind.
+    'query' is the description of the query itself.
+    """
+    return {'html': os.path.join(app.config['MPLD3_FOLDER'],
+                                 FigureStrBase + NQuery + '.html'),
+            'png': os.path.join(app.config['PNG_PLOT_FOLDER'],
+                                FigureStrBase + NQuery + '.png'),
+            'json': os.path.join(app.config['TABLE_FOLDER'],
+                                 DataStrBase + NQuery + '.json'),
+            'query': os.path.join(app.config['TABLE_FOLDER'],
+                                  QueryStrBase + NQuery + '.json')}
+
+
+def parse_query_outputs(value):
+    """
+    Parse a comma-separated list of query outputs
+    """
+    if not value:
+        return list(default_query_outputs)
+    outputs = [output.strip().lower() for output in value.split(',')
+               if output.strip()]
+    unknown = [output for output in outputs if output not in query_outputs]
+    if unknown:
+        raise InvalidUsage("Unknown output(s) {0}; choose from {1}"
+                           .format(", ".join(unknown),
+                                   ", ".join(query_outputs)))
+    return outputs
+
+
+def render_query_outputs(NQuery, merged_table_name, bounds, flags, outputs):
+    """
+    Make those of the requested outputs of a query that are not on disk yet.
+    Returns False if nothing matches the query.  The plots are not made if
+    none of the matching data are within the plotted range (see
+    `send_query_output`).
+    """
+    paths = query_output_paths(NQuery)
+    missing = [output for output in outputs
+               if not touch_artifacts([paths[output]])]
+    if not missing:
+        log.debug("Serving query {0} from the render cache".format(NQuery))
+        record_outputs([paths[output] for output in outputs])
+        return True
+
+    table, index = get_merged_table(merged_table_name, return_index=True)
+    use_table = query_table(table, bounds, index=index, **flags)
+    if len(use_table) == 0:
+        return False
+
+    if 'json' in missing:
+        with open(paths['json'], 'w') as f:
+            json.dump(table_columns(use_table), f)
+
+    plots = [output for output in missing if output in plot_outputs]
+    if plots:
+        # limits left out of the query, or open-ended, are the default ones
+        # of the plot
+        plot_limits = {}
+        for colname, limit_names in plot_limit_names.items():
+            for name, limit in zip(limit_names, bounds.get(colname, ())):
+                if np.isfinite(limit.value):
+                    plot_limits[name] = limit
+        myplot_html, myplot_png = \
+            plotData_Sigma_sigma(NQuery, use_table, FigureStrBase,
+                                 html_dir=app.config['MPLD3_FOLDER'],
+                                 png_dir=app.config['PNG_PLOT_FOLDER'],
+                                 tooltip_columns=tooltip_column_names,
+                                 outputs=plots, max_points=plot_max_points,
+                                 **plot_limits)
+        if myplot_html is None and myplot_png is None:
+            log.debug("None of the {0} rows of query {1} are within the "
+                      "plotted range".format(len(use_table), NQuery))
+
+    record_outputs([paths[output] for output in outputs])
+    return True
+
+
 @app.route('/query/<path:filename>', methods=['POST'])
 def query(filename, fileformat=None):
-    SurfMin = float(request.form['SurfaceDensity_min']) * \
-        u.Unit(request.form['SurfaceDensity_unit'])
-    SurfMax = float(request.form['SurfaceDensity_max']) * \
-        u.Unit(request.form['SurfaceDensity_unit'])
-    VDispMin = float(request.form['VelocityDispersion_min']) * \
-        u.Unit(request.form['VelocityDispersion_unit'])
-    VDispMax = float(request.form['VelocityDispersion_max']) * \
-        u.Unit(request.form['VelocityDispersion_unit'])
-    RadMin = float(request.form['Radius_min']) * \
-        u.Unit(request.form['Radius_unit'])
-    RadMax = float(request.form['Radius_max']) * \
-        u.Unit(request.form['Radius_unit'])
-
-    ShowObs = (request.form['ObsSimBoth'] == 'IsObserved') or \
-        (request.form['ObsSimBoth'] == 'IsObsSim')
-    ShowSim = (request.form['ObsSimBoth'] == 'IsSimulated') or \
-        (request.form['ObsSimBoth'] == 'IsObsSim')
-    ShowGal = (request.form['GalExgalBoth'] == 'IsGalactic') or \
-        (request.form['GalExgalBoth'] == 'IsGalExgal')
-    ShowExgal = (request.form['GalExgalBoth'] == 'IsExtragalactic') or \
-        (request.form['GalExgalBoth'] == 'IsGalExgal')
-
-    NQuery = timeString()
-
-    clearOutput()
-
-    table = Table.read(os.path.join(app.config['DATABASE_FOLDER'], filename),
-                       format='ascii.ipac')
-    set_units(table)
-
-    temp_table = [table[index].index for index, (surfdens, vdisp, radius) in
-                  enumerate(zip(table['SurfaceDensity'],
-                                table['VelocityDispersion'],
-                                table['Radius']))
-                  if (SurfMin < surfdens * table['SurfaceDensity'].unit < SurfMax and
-                      VDispMin < vdisp * table['VelocityDispersion'].unit < VDispMax and
-                      RadMin < radius * table['Radius'].unit < RadMax)]
-    use_table = table[temp_table]
-
-    if not ShowObs:
-        temp_table = [use_table[h].index for h, i in
-                      zip(list(range(len(use_table))), use_table['IsSimulated'])
-                      if i == 'False']
-        use_table.remove_rows(temp_table)
-
-    if not ShowSim:
-        temp_table = [use_table[h].index for h, i in
-                      zip(list(range(len(use_table))), use_table['IsSimulated'])
-                      if i == 'True']
-        use_table.remove_rows(temp_table)
-
-    if not ShowGal:
-        temp_table = [use_table[h].index for h, i in
-                      zip(list(range(len(use_table))), use_table['IsGalactic'])
-                      if i == 'True']
-        use_table.remove_rows(temp_table)
-
-    if not ShowExgal:
-        temp_table = [use_table[h].index for h, i in
-                      zip(list(range(len(use_table))), use_table['IsGalactic'])
-                      if i == 'False']
-        use_table.remove_rows(temp_table)
-
-    tablefile = os.path.join(app.config['TABLE_FOLDER'],
-                             TableStrBase + NQuery + '.ipac')
-
-    use_table.write(tablefile, format='ipac')
+    """
+    Select the entries of the database that match the query form, and show
+    them.  The optional ``outputs`` parameter is a comma-separated list of the
+    outputs to make straight away, among 'html' (interactive plot), 'png' and
+    'json' (the selected data); the default is html,png.  Every output can
+    still be fetched later from its `query_output` URL, which makes it on
+    demand.  If a single output other than html is requested, it is returned
+    instead of the result page.  The selected table itself is not written
+    out: `query_download` streams it in the format the user picks.
+    """
+    bounds, flags = parse_query(request.form)
+    outputs = parse_query_outputs(request.values.get('outputs'))
 
-    myplot_html, myplot_png = \
-        plotData_Sigma_sigma(NQuery, use_table, FigureStrBase,
-                             SurfMin=SurfMin, SurfMax=SurfMax,
-                             VDispMin=VDispMin, VDispMax=VDispMax,
-                             RadMin=RadMin, RadMax=RadMax,
-                             html_dir=app.config['MPLD3_FOLDER'],
-                             png_dir=app.config['PNG_PLOT_FOLDER'])
+    merged_table_name = os.path.join(app.config['DATABASE_FOLDER'], filename)
+    version = get_table_version(merged_table_name)
+
+    # The outputs are named after the query and the database version, so
+    # that a repeated query can be served from the previous outputs
+    NQuery = query_key(bounds, flags, version)
+    paths = query_output_paths(NQuery)
+
+    if not touch_artifacts([paths['query']]):
+        # remember the query, for making the other outputs on demand
+        with open(paths['query'], 'w') as f:
+            json.dump({'filename': filename, 'version': version,
+                       'form': {key: request.form[key]
+                                for key in request.form}}, f)
+    record_outputs([paths['query']])
 
     # It is possible to create an empty query
-    if myplot_html is None or myplot_png is None:
+    if not render_query_outputs(NQuery, merged_table_name, bounds, flags,
+                                outputs):
         return render_template('error.html',
                                error="No data were found matching your query.",
                                traceback="")
 
-    return render_template('show_plot.html', imagename='/' + myplot_html,
-                           png_imagename="/" + myplot_png,
-                           tablefile=tablefile)
+    if len(outputs) == 1 and outputs[0] != 'html':
+        return send_query_output(NQuery, outputs[0])
+
+    if 'html' in outputs and not os.path.exists(paths['html']):
+        errormessage = ("None of the data matching your query are within the "
+                        "range of the plot; they can still be downloaded.")
+    else:
+        errormessage = None
+    return render_template('show_plot.html', errormessage=errormessage,
+                           imagename=url_for('query_output', NQuery=NQuery,
+                                             output='html'),
+                           png_imagename=url_for('query_output', NQuery=NQuery,
+                                                 output='png'),
+                           downloadurl=url_for('query_download',
+                                               NQuery=NQuery),
+                           download_formats=list(download_formats))
+
+
+def load_query(NQuery):
+    """
+    Load the description of an earlier query.  Returns the database table
+    it was made on and the parsed query, ``(merged_table_name, bounds,
+    flags)``.
+    """
+    try:
+        with open(query_output_paths(NQuery)['query']) as f:
+            description = json.load(f)
+    except (IOError, ValueError):
+        raise InvalidUsage("This query has expired; please submit it "
+                           "again", status_code=404)
+
+    merged_table_name = os.path.join(app.config['DATABASE_FOLDER'],
+                                     description['filename'])
+    if get_table_version(merged_table_name) != description['version']:
+        raise InvalidUsage("The database has changed since this query "
+                           "was made; please submit it again",
+                           status_code=410)
+    bounds, flags = parse_query(description['form'])
+    return merged_table_name, bounds, flags
+
+
+@app.route('/query_output/<NQuery>/<output>')
+def query_output(NQuery, output):
+    """
+    Serve one output of an earlier query, making it first if it was not
+    requested at the time
+    """
+    if not re.match('^[0-9a-f]+$', NQuery) or output not in query_outputs:
+        raise InvalidUsage("No such query output", status_code=404)
+    paths = query_output_paths(NQuery)
+
+    if not touch_artifacts([paths[output]]):
+        merged_table_name, bounds, flags = load_query(NQuery)
+        if not render_query_outputs(NQuery, merged_table_name, bounds, flags,
+                                    [output]):
+            raise InvalidUsage("No data were found matching this query",
+                               status_code=404)
+    else:
+        record_outputs([paths[output]])
+
+    return send_query_output(NQuery, output)
+
+
+def send_query_output(NQuery, output):
+    """
+    Send an output of a query made by `render_query_outputs`
+    """
+    path = query_output_paths(NQuery)[output]
+    if not os.path.exists(path):
+        # the plots of data that are all outside of the plotted range
+        raise InvalidUsage("None of the data matching this query are within "
+                           "the range of the plot", status_code=404)
+    return send_from_directory(os.path.dirname(path), os.path.basename(path))
+
+
+@app.route('/query_download/<NQuery>')
+def query_download(NQuery):
+    """
+    Download the table selected by an earlier query.  The ``format``
+    parameter is one of ``download_formats`` (default: ipac).  The table is
+    made from the query when it is requested and streamed a chunk of rows at
+    a time, gzip-compressed if the client accepts it.
+    """
+    if not re.match('^[0-9a-f]+$', NQuery):
+        raise InvalidUsage("No such query", status_code=404)
+    dataformat = request.args.get('format', 'ipac').lower()
+    if dataformat not in download_formats:
+        raise InvalidUsage("Unknown format {0}; choose from {1}"
+                           .format(dataformat, ", ".join(download_formats)))
+
+    merged_table_name, bounds, flags = load_query(NQuery)
+    query_path = query_output_paths(NQuery)['query']
+    touch_artifacts([query_path])
+    record_outputs([query_path])
+    table, index = get_merged_table(merged_table_name, return_index=True)
+    rows = query_rows(table, bounds, index=index, **flags)
+
+    body = stream_table(table, rows, dataformat)
+    mimetype, extension = download_formats[dataformat]
+    headers = {'Content-Disposition':
+               'attachment; filename={0}{1}{2}'.format(TableStrBase, NQuery,
+                                                       extension)}
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        body = gzip_stream(body)
+        headers['Content-Encoding'] = 'gzip'
+    return app.response_class(stream_with_context(body), mimetype=mimetype,
+                              headers=headers)
+
+
+@app.route('/api/query', methods=['GET', 'POST'])
+@app.route('/api/query/<path:filename>', methods=['GET', 'POST'])
+def api_query(filename='merged_table.ipac'):
+    """
+    Query the database for scripts: nothing is plotted or written to disk.
+
+    The parameters, given as a JSON object or as form / URL parameters, are
+    those of the query form (``SurfaceDensity_min``, ``Radius_unit``,
+    ``ObsSimBoth``, ...; any of them can be left out, see `parse_query`),
+    plus:
+
+    * ``format``: 'json' (default) for ``{'nrows': ..., 'columns': {name:
+      values}, 'units': {name: unit}}``, or 'fits' for a FITS table
+    * ``columns``: the columns to return, as a list or a comma-separated
+      string (default: all)
+
+    The response is gzip-compressed if the client accepts it.
+    """
+    params = request.get_json(silent=True) or request.values
+    try:
+        bounds, flags = parse_query(params)
+    except (ValueError, TypeError, u.UnitsError) as ex:
+        raise InvalidUsage("Invalid query: {0}".format(ex))
+
+    dataformat = params.get('format', 'json')
+    if dataformat not in api_formats:
+        raise InvalidUsage("Unknown format {0}; choose from {1}"
+                           .format(dataformat, ", ".join(api_formats)))
+
+    table, index = \
+        get_merged_table(os.path.join(app.config['DATABASE_FOLDER'], filename),
+                         return_index=True)
+    use_table = query_table(table, bounds, index=index, **flags)
+
+    columns = params.get('columns')
+    if columns:
+        if not isinstance(columns, list):
+            columns = columns.split(',')
+        unknown = [col for col in columns if col not in use_table.colnames]
+        if unknown:
+            raise InvalidUsage("Unknown column(s) {0}".format(
+                ", ".join(unknown)))
+        use_table = use_table[columns]
+
+    if dataformat == 'fits':
+        buf = io.BytesIO()
+        use_table.write(buf, format='fits')
+        body = buf.getvalue()
+        mimetype = 'application/fits'
+    else:
+        data = table_columns(use_table)
+        data['nrows'] = len(use_table)
+        body = json.dumps(data).encode('utf-8')
+        mimetype = 'application/json'
+
+    response = app.response_class(body, mimetype=mimetype)
+    if 'gzip' in request.headers.get('Accept-Encoding', ''):
+        buf = io.BytesIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb') as f:
+            f.write(body)
+        response.set_data(buf.getvalue())
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
 
 
 @app.route('/query/static/jstables/<path:path>')
@@ -1025,6 +1565,33 @@ def send_js(path):
     return send_from_directory('static/jstables/', path)
 
 
+@app.before_first_request
+def start_submission_worker():
+    """
+    Run queued submissions in a background thread of this server process
+    """
+    start_worker()
+
+
+@app.before_first_request
+def start_artifact_janitor():
+    """
+    Keep the generated plots and tables under ``artifact_budget`` bytes, from
+    a background thread of this server process
+    """
+    start_janitor(artifact_folders, artifact_budget,
+                  prefixes=artifact_prefixes, interval=janitor_interval)
+
+
+@app.route('/janitor_status')
+def janitor_status():
+    """
+    Report the disk usage of the generated files and how much the janitor has
+    reclaimed, as JSON
+    """
+    return jsonify(janitor_stats())
+
+
 @app.before_first_request
 def setup_authenticate_with_github():
     """
@@ -1168,6 +1735,10 @@ def update_database():
     cleanup_git_directory('database/')
     cleanup_git_directory('uploads/')
 
+    # reload the served table and regenerate its snapshot
+    refresh_merged_table(os.path.join(app.config['DATABASE_FOLDER'],
+                                      'merged_table.ipac'))
+
     S = requests.Session()
     S.headers['User-Agent'] = 'camelot-project ' + S.headers['User-Agent']
 
@@ -1231,6 +1802,10 @@ def store_form_data(request, fileformat, unique_filename):
     with open(json_filename, 'w') as f:
         json.dump(form_data, f)
 
+    # count this mapping with those of the earlier uploads from now on
+    for targets in (matched_column_names, tuple(use_column_names)):
+        get_column_matcher(targets).add_form(request.form)
+
 
 def handle_email(email, filename):
     form_url = 'https://docs.google.com/forms/d/1nzdc8jOMlwZEYqdJSvNo6B60gNrUZ9trrhUeYRtUM8g/formResponse'
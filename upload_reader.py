@@ -0,0 +1,239 @@
+"""
+Chunked reading of uploaded tables.
+
+Uploads can be much larger than anything we want to hold in memory several
+times over.  The column-mapping page only needs the column names, units and
+metadata, which `read_sample` gets from the header and the first few rows.
+`iter_chunks` then hands the table to `set_columns` a block of rows at a time,
+so that the ingestion pipeline never holds more than one block of the raw
+upload.
+
+Plain-text formats are split on lines: every chunk is parsed together with a
+copy of the file header (the comment, IPAC ``\\`` and ``|`` or ECSV ``#``
+lines, followed by the column name line where the format has one), so each
+chunk is a complete table in the upload's format.  This assumes that a row
+never spans several lines, which holds for the formats in
+``streamed_text_formats``.  FITS tables are memory-mapped and sliced.  Any
+other format is read in one go and then sliced.
+
+Uploads of up to ``CACHED_UPLOAD_SIZE`` bytes are instead parsed whole once
+and kept in the `upload_cache`, so that the column-mapping page and the
+ingestion both work from the same parsed table.
+
+`iter_chunks` can be restricted to the columns that are actually ingested
+(``include_names``): the plain-text readers then only convert those columns,
+and FITS tables only read them from the memory map.
+"""
+
+import os
+import csv
+import itertools
+from astropy.io import registry
+from astropy.table import Table
+from astropy import log
+from table_store import file_digest
+from upload_cache import parse_upload, load_parsed_upload
+
+SAMPLE_ROWS = 100
+SNIFF_BYTES = 8192
+CHUNK_ROWS = 50000
+CACHED_UPLOAD_SIZE = 64 * 2**20
+
+# Plain-text formats that can be split on lines, with the number of header
+# lines that follow the leading comment lines (e.g. the column names)
+streamed_text_formats = {'ascii.ipac': 0, 'ipac': 0,
+                         'ascii.ecsv': 1, 'ecsv': 1,
+                         'ascii.csv': 1, 'csv': 1,
+                         'ascii.tab': 1,
+                         'ascii.basic': 1,
+                         'ascii.commented_header': 0,
+                         'ascii.rdb': 2, 'rdb': 2}
+
+fits_formats = ('fits',)
+
+comment_markers = ('#', '\\', '|')
+
+
+# Formats of delimited text, by delimiter
+delimited_formats = {',': 'ascii.csv', '\t': 'ascii.tab', ' ': 'ascii.basic'}
+
+
+def _is_number(value):
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+
+def sniff_format(filename, nbytes=SNIFF_BYTES):
+    """
+    Guess the format of a table from its first ``nbytes`` bytes.
+
+    Recognizes FITS files, ECSV, IPAC and CDS/MRT headers, and otherwise
+    looks for the delimiter of a CSV, tab-separated or whitespace-separated
+    table.  Returns None if the file does not look like any of those.
+    """
+    with open(filename, 'rb') as f:
+        head = f.read(nbytes)
+
+    if head.startswith(b'SIMPLE  ='):
+        return 'fits'
+    text = head.decode('utf-8', errors='replace')
+    if text.startswith('# %ECSV'):
+        return 'ascii.ecsv'
+    if '<VOTABLE' in text:
+        return 'votable'
+    if 'Byte-by-byte Description of file' in text:
+        return 'ascii.cds'
+
+    lines = text.splitlines()
+    if len(head) == nbytes:
+        # the last line is probably cut short
+        lines = lines[:-1]
+    if any(line.startswith('|') for line in lines):
+        return 'ascii.ipac'
+
+    comments = [line for line in lines if line.startswith('#')]
+    rows = [line for line in lines
+            if line.strip() and not line.startswith('#')]
+    if not rows:
+        return None
+    try:
+        dialect = csv.Sniffer().sniff('\n'.join(rows[:50]),
+                                      delimiters=''.join(delimited_formats))
+    except csv.Error:
+        return None
+    fileformat = delimited_formats[dialect.delimiter]
+
+    if fileformat == 'ascii.basic' and comments:
+        # column names in the last comment line rather than in the first row
+        names = comments[-1][1:].split()
+        first_row = next(csv.reader([rows[0]], delimiter=' ',
+                                    skipinitialspace=True))
+        if (len(names) == len(first_row) and
+                not any(_is_number(name) for name in names) and
+                any(_is_number(value) for value in first_row)):
+            return 'ascii.commented_header'
+
+    return fileformat
+
+
+def resolve_format(filename, fileformat=None):
+    """
+    Return the format ``filename`` would be read with, or None if it is
+    ambiguous
+    """
+    if fileformat is not None:
+        return fileformat
+    sniffed = sniff_format(filename)
+    if sniffed is not None:
+        return sniffed
+    try:
+        formats = registry.identify_format('read', Table, filename, None,
+                                           [filename], {})
+    except Exception as ex:
+        log.debug("Could not identify the format of {0}: {1}"
+                  .format(filename, ex))
+        return None
+    if len(formats) == 1:
+        return formats[0]
+    return None
+
+
+def split_header(lines, fileformat):
+    """
+    Take the header lines of a plain-text table off an iterator over its
+    lines.  Returns the header and an iterator over the remaining lines.
+    """
+    header = []
+    for line in lines:
+        if line.strip() and not line.startswith(comment_markers):
+            lines = itertools.chain([line], lines)
+            break
+        header.append(line)
+    header.extend(itertools.islice(lines, streamed_text_formats[fileformat]))
+    return header, lines
+
+
+def _iter_text_chunks(filename, fileformat, chunk_rows, include_names=None):
+    kwargs = {} if include_names is None else {'include_names':
+                                               include_names}
+    with open(filename) as fileobj:
+        header, lines = split_header(fileobj, fileformat)
+        while True:
+            chunk = list(itertools.islice(lines, chunk_rows))
+            if not any(line.strip() for line in chunk):
+                break
+            yield Table.read(''.join(header + chunk), format=fileformat,
+                             **kwargs)
+
+
+def select_columns(table, include_names=None):
+    """
+    Keep only the ``include_names`` columns of ``table`` (all of them if
+    None), in the order of the table
+    """
+    if include_names is None:
+        return table
+    return table[[colname for colname in table.colnames
+                  if colname in include_names]]
+
+
+def _iter_sliced_chunks(table, chunk_rows, include_names=None):
+    table = select_columns(table, include_names)
+    for start in range(0, len(table), chunk_rows):
+        yield table[start:start + chunk_rows]
+
+
+def is_cached_size(filename):
+    """
+    Whether an upload is small enough to be parsed whole and cached
+    """
+    return os.path.getsize(filename) <= CACHED_UPLOAD_SIZE
+
+
+def iter_chunks(filename, fileformat=None, chunk_rows=CHUNK_ROWS,
+                digest=None, include_names=None):
+    """
+    Iterate over an uploaded table in tables of at most ``chunk_rows`` rows.
+    Without a ``fileformat``, the format is sniffed from the contents of the
+    file (see `resolve_format`) rather than guessed from its extension.
+    ``digest`` is the SHA-1 of the file contents, if already known.  If
+    ``include_names`` is given, the chunks only have those of the columns.
+    """
+    resolved = resolve_format(filename, fileformat)
+    if is_cached_size(filename):
+        if digest is None:
+            digest = file_digest(filename)
+        table = load_parsed_upload(digest, resolved)
+        if table is not None:
+            log.debug("Using the cached parse of {0}".format(filename))
+            return _iter_sliced_chunks(table, chunk_rows, include_names)
+
+    if resolved in streamed_text_formats:
+        log.debug("Streaming {0} as {1} in chunks of {2} rows"
+                  .format(filename, resolved, chunk_rows))
+        return _iter_text_chunks(filename, resolved, chunk_rows,
+                                 include_names)
+    elif resolved in fits_formats:
+        table = Table.read(filename, format=resolved, memmap=True)
+        return _iter_sliced_chunks(table, chunk_rows, include_names)
+    else:
+        table = Table.read(filename, format=resolved)
+        return _iter_sliced_chunks(table, chunk_rows, include_names)
+
+
+def read_sample(filename, fileformat=None, nrows=SAMPLE_ROWS, digest=None):
+    """
+    Read the header and the first ``nrows`` rows of an uploaded table.  Small
+    uploads are parsed whole, and cached for `iter_chunks`.
+    """
+    resolved = resolve_format(filename, fileformat)
+    if is_cached_size(filename):
+        return parse_upload(filename, resolved, digest=digest)[:nrows]
+
+    for chunk in iter_chunks(filename, resolved, chunk_rows=nrows):
+        return chunk
+    # no data rows at all: let the reader make sense of the file
+    return Table.read(filename, format=resolved)